@@ -0,0 +1,82 @@
+""" Pathfinding benchmark on a synthetic graph
+
+    python benchmark_pathfind.py [nodes] [channels] [queries]
+
+Builds a random graph where a few hubs have most channels, like the Lightning Network, then
+times single routes and num_routes=5 between random node pairs with a Pathfinder, and repricing
+the paths found with price() one by one and with price_many().
+"""
+import random
+import statistics
+import sys
+import time
+
+import rpc_pb2 as ln
+from graph import ChannelGraph
+from pathfind import NoRouteError, Pathfinder
+
+
+def synthetic_graph(num_nodes=8000, num_channels=40000, seed=1):
+    rng = random.Random(seed)
+    pubkeys = ['02' + node.to_bytes(32, 'big').hex() for node in range(num_nodes)]
+    # preferential attachment by weight: node i is picked ~1 / (i + 10)
+    weights = [1 / (node + 10) for node in range(num_nodes)]
+    graph = ChannelGraph()
+    for pubkey in pubkeys:
+        graph.set_node(pubkey, '')
+    chan_id = 0
+    while len(graph) < num_channels:
+        node1, node2 = rng.choices(range(num_nodes), weights)[0], rng.randrange(num_nodes)
+        if node1 == node2:
+            continue
+        chan_id += 1
+        graph.add_channel(chan_id, pubkeys[node1], pubkeys[node2], rng.choice((1, 2, 5, 10, 50)) * 1000000)
+        for pubkey in (pubkeys[node1], pubkeys[node2]):
+            graph.set_policy(chan_id, pubkey, ln.RoutingPolicy(
+                time_lock_delta=rng.choice((18, 40, 80, 144)), min_htlc=1000, fee_base_msat=rng.choice((0, 1000)),
+                fee_rate_milli_msat=rng.choice((1, 10, 100, 500)), disabled=rng.random() < 0.05))
+    return graph, pubkeys
+
+
+def timed(finder, pairs, amt_msat, num_routes, found=None):
+    samples = []
+    for source, destination in pairs:
+        finder.source = source
+        started = time.perf_counter()
+        try:
+            paths = finder.find_paths(destination, amt_msat, num_routes=num_routes)
+        except NoRouteError:
+            paths = []
+        samples.append(time.perf_counter() - started)
+        if found is not None:
+            found.extend(path.edges for path in paths)
+    return samples
+
+
+def run(num_nodes=8000, num_channels=40000, queries=50, amt_msat=100000000):
+    graph, pubkeys = synthetic_graph(num_nodes, num_channels)
+    rng = random.Random(2)
+    pairs = [tuple(rng.sample(pubkeys, 2)) for _ in range(queries)]
+    finder = Pathfinder(graph, pairs[0][0])
+    finder.find_paths(pairs[0][1], amt_msat)  # builds the columns
+
+    print(f'{graph.num_nodes} nodes, {len(graph)} channels, {queries} queries of {amt_msat // 1000} sat, median')
+    found = []
+    for num_routes in (1, 5):
+        samples = timed(finder, pairs, amt_msat, num_routes, found)
+        print(f'num_routes={num_routes}: {statistics.median(samples) * 1000:7.1f} ms, '
+              f'{len(samples) / sum(samples):7.1f} queries/s')
+
+    # candidate routes for other amounts, as a payment planner would weigh them
+    candidates = (found * (10000 // len(found) + 1))[:10000]
+    started = time.perf_counter()
+    for edges in candidates:
+        finder.price(edges, amt_msat // 2)
+    print(f'price():      {len(candidates) / (time.perf_counter() - started):9.0f} paths/s')
+    started = time.perf_counter()
+    finder.price_many(candidates, amt_msat // 2)
+    print(f'price_many(): {len(candidates) / (time.perf_counter() - started):9.0f} paths/s')
+
+
+if __name__ == '__main__':
+    run(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,42 @@
+""" Startup benchmark: how long short lived jobs wait before their first RPC
+
+    python benchmark_startup.py [runs]
+
+Every run is a fresh interpreter measuring `import lnd`, then the first protobuf message and
+the first stub (which load rpc_pb2, rpc_pb2_grpc and grpc on demand).
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = '''
+import json, time
+started = time.perf_counter()
+import lnd
+imported = time.perf_counter()
+lnd.ln.GetInfoRequest()
+message = time.perf_counter()
+lnd.lnrpc.LightningStub(lnd.grpc.insecure_channel('localhost:1')).GetInfo
+stub = time.perf_counter()
+from utils import protobuf_backend
+print(json.dumps({'import lnd': imported - started, 'first message': message - imported,
+                  'first stub': stub - message, 'total': stub - started, 'backend': protobuf_backend()}))
+'''
+
+
+def run(runs=10):
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=here, stderr=subprocess.DEVNULL)
+        samples.append(json.loads(output))
+
+    print(f'protobuf backend: {samples[0]["backend"]}, {runs} runs, median')
+    for name in ('import lnd', 'first message', 'first stub', 'total'):
+        print(f'{name:>14}: {statistics.median(sample[name] for sample in samples) * 1000:7.1f} ms')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,385 @@
+""" Offline BOLT11 payment request decoder
+
+    decode() returns the same ln.PayReq that lnd's DecodePayReq does, without the round trip.
+    The destination is recovered from the signature, or taken from the `n` field and the signature
+    verified against it. Both take a few milliseconds in pure Python and microseconds with coincurve
+    (libsecp256k1), so without coincurve requests with an `n` field are not verified unless
+    verify=True is passed: a forged request then decodes, where DecodePayReq would reject it.
+
+        details = bolt11.decode(pay_req)
+        many = bolt11.decode_many(pay_reqs)
+"""
+import hashlib
+
+from utils import lazy_import
+
+ln = lazy_import('rpc_pb2')
+
+try:
+    from coincurve import PublicKey as _CoincurvePublicKey
+except ImportError:
+    _CoincurvePublicKey = None
+
+# Check the signature against the `n` field unless told otherwise, only where that is cheap
+VERIFY_NODE_ID = _CoincurvePublicKey is not None
+
+CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+CHARSET_REV = {c: i for i, c in enumerate(CHARSET)}
+
+# BTC amount multipliers, as divisors of 1 BTC = 10^11 msat
+MULTIPLIERS = {'m': 10 ** 3, 'u': 10 ** 6, 'n': 10 ** 9, 'p': 10 ** 12}
+MSAT_PER_BTC = 10 ** 11
+
+DEFAULT_EXPIRY = 3600
+DEFAULT_MIN_FINAL_CLTV_EXPIRY = 9
+
+# currency prefix -> (segwit hrp, p2pkh version, p2sh version)
+NETWORKS = {
+    'bc': ('bc', 0x00, 0x05),
+    'tb': ('tb', 0x6f, 0xc4),
+    'bcrt': ('bcrt', 0x6f, 0xc4),
+    'sb': ('sb', 0x3f, 0x7b),
+}
+
+# tagged field types
+TAG_PAYMENT_HASH = 1
+TAG_ROUTE_HINT = 3
+TAG_EXPIRY = 6
+TAG_FALLBACK = 9
+TAG_DESCRIPTION = 13
+TAG_PAYMENT_SECRET = 16
+TAG_NODE_ID = 19
+TAG_DESCRIPTION_HASH = 23
+TAG_MIN_FINAL_CLTV_EXPIRY = 24
+
+SIGNATURE_GROUPS = 104  # 65 bytes
+TIMESTAMP_GROUPS = 7
+HOP_HINT_LENGTH = 51
+
+# secp256k1
+P = 2 ** 256 - 2 ** 32 - 977
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+
+def _polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+def _hrp_expand(hrp):
+    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+
+
+def bech32_decode(bech):
+    """ (hrp, [5 bit groups]) without checksum, no length limit as BOLT11 requires """
+    if bech.lower() != bech and bech.upper() != bech:
+        raise ValueError('Mixed case payment request')
+    bech = bech.lower()
+    pos = bech.rfind('1')
+    if pos < 1 or pos + 7 > len(bech):
+        raise ValueError('Invalid bech32 separator position')
+    hrp = bech[:pos]
+    try:
+        data = [CHARSET_REV[c] for c in bech[pos + 1:]]
+    except KeyError as e:
+        raise ValueError(f'Invalid bech32 character {e}')
+    if _polymod(_hrp_expand(hrp) + data) != 1:
+        raise ValueError('Invalid bech32 checksum')
+    return hrp, data[:-6]
+
+
+def bech32_encode(hrp, data):
+    values = _hrp_expand(hrp) + data
+    polymod = _polymod(values + [0] * 6) ^ 1
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(CHARSET[d] for d in data + checksum)
+
+
+def convertbits(data, frombits, tobits, pad=True):
+    acc = 0
+    bits = 0
+    ret = []
+    maxv = (1 << tobits) - 1
+    for value in data:
+        acc = (acc << frombits) | value
+        bits += frombits
+        while bits >= tobits:
+            bits -= tobits
+            ret.append((acc >> bits) & maxv)
+    if pad and bits:
+        ret.append((acc << (tobits - bits)) & maxv)
+    return ret
+
+
+def _int(groups):
+    value = 0
+    for group in groups:
+        value = value << 5 | group
+    return value
+
+
+def _bytes(groups):
+    return bytes(convertbits(groups, 5, 8, pad=False))
+
+
+def _base58check(version, payload):
+    alphabet = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+    raw = bytes([version]) + payload
+    raw += hashlib.sha256(hashlib.sha256(raw).digest()).digest()[:4]
+    value = int.from_bytes(raw, 'big')
+    encoded = ''
+    while value:
+        value, mod = divmod(value, 58)
+        encoded = alphabet[mod] + encoded
+    return '1' * (len(raw) - len(raw.lstrip(b'\0'))) + encoded
+
+
+def parse_hrp(hrp):
+    """ (currency, amount in msat or None) """
+    if not hrp.startswith('ln'):
+        raise ValueError(f'Invalid payment request prefix {hrp}')
+    rest = hrp[2:]
+    currency = next((c for c in sorted(NETWORKS, key=len, reverse=True) if rest.startswith(c)), None)
+    if currency is None:
+        raise ValueError(f'Unknown currency in {hrp}')
+    amount = rest[len(currency):]
+    if not amount:
+        return currency, None
+
+    multiplier = amount[-1] if amount[-1] in MULTIPLIERS else None
+    digits = amount[:-1] if multiplier else amount
+    if not digits.isdigit():
+        raise ValueError(f'Invalid amount {amount}')
+    if multiplier is None:
+        return currency, int(digits) * MSAT_PER_BTC
+    msat, remainder = divmod(int(digits) * MSAT_PER_BTC, MULTIPLIERS[multiplier])
+    if remainder:
+        raise ValueError(f'Amount {amount} is not a whole number of msat')
+    return currency, msat
+
+
+# secp256k1 in Jacobian coordinates (a = 0)
+
+def _double(p):
+    x, y, z = p
+    if not y:
+        return 0, 0, 0
+    ysq = y * y % P
+    s = 4 * x * ysq % P
+    m = 3 * x * x % P
+    nx = (m * m - 2 * s) % P
+    ny = (m * (s - nx) - 8 * ysq * ysq) % P
+    return nx, ny, 2 * y * z % P
+
+
+def _add(p, q):
+    if not p[2]:
+        return q
+    if not q[2]:
+        return p
+    x1, y1, z1 = p
+    x2, y2, z2 = q
+    z1sq = z1 * z1 % P
+    z2sq = z2 * z2 % P
+    u1 = x1 * z2sq % P
+    u2 = x2 * z1sq % P
+    s1 = y1 * z2sq * z2 % P
+    s2 = y2 * z1sq * z1 % P
+    if u1 == u2:
+        return _double(p) if s1 == s2 else (0, 0, 0)
+    h = u2 - u1
+    r = s2 - s1
+    hsq = h * h % P
+    hcu = hsq * h % P
+    u1hsq = u1 * hsq % P
+    nx = (r * r - hcu - 2 * u1hsq) % P
+    ny = (r * (u1hsq - nx) - s1 * hcu) % P
+    return nx, ny, h * z1 * z2 % P
+
+
+def _affine(p):
+    x, y, z = p
+    zinv = pow(z, -1, P)
+    return x * zinv * zinv % P, y * zinv * zinv * zinv % P
+
+
+def _double_multiply(a, pa, b, pb):
+    """ a * pa + b * pb (Shamir's trick) """
+    pa = (pa[0], pa[1], 1)
+    pb = (pb[0], pb[1], 1)
+    both = _add(pa, pb)
+    result = (0, 0, 0)
+    for i in range(max(a.bit_length(), b.bit_length()) - 1, -1, -1):
+        result = _double(result)
+        bits = (a >> i & 1, b >> i & 1)
+        if bits == (1, 1):
+            result = _add(result, both)
+        elif bits[0]:
+            result = _add(result, pa)
+        elif bits[1]:
+            result = _add(result, pb)
+    return result
+
+
+def recover_pubkey(signature, msg_hash):
+    """ Compressed public key (bytes) from a 65 byte r || s || recovery id signature """
+    if _CoincurvePublicKey is not None:
+        return _CoincurvePublicKey.from_signature_and_message(signature, msg_hash, hasher=None).format()
+
+    r = int.from_bytes(signature[:32], 'big')
+    s = int.from_bytes(signature[32:64], 'big')
+    recovery_id = signature[64]
+    if not (0 < r < N and 0 < s < N) or recovery_id > 3:
+        raise ValueError('Invalid signature')
+
+    x = r + N if recovery_id & 2 else r
+    if x >= P:
+        raise ValueError('Invalid signature')
+    y = pow((x * x * x + 7) % P, (P + 1) // 4, P)
+    if (y * y - x * x * x - 7) % P:
+        raise ValueError('Invalid signature')
+    if y & 1 != recovery_id & 1:
+        y = P - y
+
+    e = int.from_bytes(msg_hash, 'big')
+    r_inv = pow(r, -1, N)
+    point = _double_multiply(-e * r_inv % N, G, s * r_inv % N, (x, y))
+    if not point[2]:
+        raise ValueError('Invalid signature')
+    qx, qy = _affine(point)
+    return bytes([2 + (qy & 1)]) + qx.to_bytes(32, 'big')
+
+
+def verify_signature(signature, msg_hash, pubkey):
+    """ Whether a 65 byte r || s || recovery id signature is pubkey's (33 bytes, compressed) """
+    if _CoincurvePublicKey is not None:
+        try:
+            return recover_pubkey(signature, msg_hash) == pubkey
+        except ValueError:
+            return False
+
+    r = int.from_bytes(signature[:32], 'big')
+    s = int.from_bytes(signature[32:64], 'big')
+    if not (0 < r < N and 0 < s < N) or len(pubkey) != 33 or pubkey[0] not in (2, 3):
+        return False
+    x = int.from_bytes(pubkey[1:], 'big')
+    y = pow((x * x * x + 7) % P, (P + 1) // 4, P)
+    if x >= P or (y * y - x * x * x - 7) % P:
+        return False
+    if y & 1 != pubkey[0] & 1:
+        y = P - y
+
+    s_inv = pow(s, -1, N)
+    point = _double_multiply(int.from_bytes(msg_hash, 'big') * s_inv % N, G, r * s_inv % N, (x, y))
+    return bool(point[2]) and _affine(point)[0] % N == r
+
+
+def _fallback_address(currency, groups):
+    segwit_hrp, p2pkh, p2sh = NETWORKS[currency]
+    version = groups[0]
+    program = _bytes(groups[1:])
+    if version == 17:
+        return _base58check(p2pkh, program)
+    if version == 18:
+        return _base58check(p2sh, program)
+    if version <= 16:
+        return bech32_encode(segwit_hrp, [version] + convertbits(program, 8, 5))
+    return ''
+
+
+def _route_hint(data):
+    hints = []
+    for offset in range(0, len(data) - HOP_HINT_LENGTH + 1, HOP_HINT_LENGTH):
+        hop = data[offset:offset + HOP_HINT_LENGTH]
+        hints.append(ln.HopHint(
+            node_id=hop[:33].hex(),
+            chan_id=int.from_bytes(hop[33:41], 'big'),
+            fee_base_msat=int.from_bytes(hop[41:45], 'big'),
+            fee_proportional_millionths=int.from_bytes(hop[45:49], 'big'),
+            cltv_expiry_delta=int.from_bytes(hop[49:51], 'big'),
+        ))
+    return ln.RouteHint(hop_hints=hints)
+
+
+def decode(pay_req, verify=None):
+    """ ln.PayReq for a BOLT11 string, raises ValueError if it is malformed or its signature is not valid
+
+    :param verify: check the signature against the `n` field, by default only with coincurve installed
+                   (requests without one always are: their destination is recovered from it)
+    """
+    hrp, data = bech32_decode(pay_req.strip())
+    if len(data) < TIMESTAMP_GROUPS + SIGNATURE_GROUPS:
+        raise ValueError('Payment request too short')
+    currency, amount_msat = parse_hrp(hrp)
+
+    signed, signature = data[:-SIGNATURE_GROUPS], _bytes(data[-SIGNATURE_GROUPS:])
+    pay = ln.PayReq(
+        timestamp=_int(data[:TIMESTAMP_GROUPS]),
+        num_satoshis=(amount_msat or 0) // 1000,
+        expiry=DEFAULT_EXPIRY,
+        cltv_expiry=DEFAULT_MIN_FINAL_CLTV_EXPIRY,
+    )
+    node_id = None
+
+    position = TIMESTAMP_GROUPS
+    while position < len(signed):
+        if position + 3 > len(signed):
+            raise ValueError('Truncated tagged field')
+        tag = signed[position]
+        length = signed[position + 1] << 5 | signed[position + 2]
+        field = signed[position + 3:position + 3 + length]
+        if len(field) != length:
+            raise ValueError('Truncated tagged field')
+        position += 3 + length
+
+        # unknown tags and known tags of the wrong length are skipped as BOLT11 requires
+        if tag == TAG_PAYMENT_HASH and length == 52:
+            pay.payment_hash = _bytes(field).hex()
+        elif tag == TAG_DESCRIPTION:
+            pay.description = _bytes(field).decode('utf-8')
+        elif tag == TAG_DESCRIPTION_HASH and length == 52:
+            pay.description_hash = _bytes(field).hex()
+        elif tag == TAG_NODE_ID and length == 53:
+            node_id = _bytes(field)
+        elif tag == TAG_EXPIRY:
+            pay.expiry = _int(field)
+        elif tag == TAG_MIN_FINAL_CLTV_EXPIRY:
+            pay.cltv_expiry = _int(field)
+        elif tag == TAG_FALLBACK and length:
+            pay.fallback_addr = _fallback_address(currency, field)
+        elif tag == TAG_ROUTE_HINT:
+            pay.route_hints.extend([_route_hint(_bytes(field))])
+
+    if not pay.payment_hash:
+        raise ValueError('Payment request without payment hash')
+
+    if verify is None:
+        verify = VERIFY_NODE_ID
+    if node_id is None or verify:
+        msg_hash = hashlib.sha256(hrp.encode() + bytes(convertbits(signed, 5, 8))).digest()
+        if node_id is None:
+            node_id = recover_pubkey(signature, msg_hash)
+        elif not verify_signature(signature, msg_hash, node_id):
+            raise ValueError('Payment request signature doesn\'t match node id')
+    pay.destination = node_id.hex()
+
+    return pay
+
+
+def decode_many(pay_reqs, verify=None):
+    """ [ln.PayReq or ValueError] for a batch of payment requests """
+    results = []
+    for pay_req in pay_reqs:
+        try:
+            results.append(decode(pay_req, verify=verify))
+        except ValueError as e:
+            results.append(e)
+    return results
@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+
+class LRUCache(object):
+    """ Thread safe size- and TTL-bounded LRU mapping with hit/miss counters
+
+        Entries older than `ttl` seconds count as misses and are dropped on access,
+        the least recently used entry is evicted when `maxsize` is reached.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _missing, count=False) is not _missing
+
+    def get(self, key, default=None, count=True):
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is not _missing:
+                value, expires = entry
+                if expires is None or expires > self.clock():
+                    self._data.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return value
+                del self._data[key]
+            if count:
+                self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=_missing):
+        ttl = self.ttl if ttl is _missing else ttl
+        with self._lock:
+            self._data[key] = (value, None if ttl is None else self.clock() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _missing)
+        return default if entry is _missing else entry[0]
+
+    def items(self):
+        """ [(key, value)] of the entries not expired, dropping the expired ones """
+        with self._lock:
+            now = self.clock()
+            for key in [key for key, (value, expires) in self._data.items() if expires is not None and expires <= now]:
+                del self._data[key]
+            return [(key, value) for key, (value, expires) in self._data.items()]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,159 @@
+import codecs
+import itertools
+import logging
+import os
+import threading
+
+from utils import lazy_import
+
+grpc = lazy_import('grpc')
+
+logger = logging.getLogger(__name__)
+
+# Production defaults, override per node with a 'channel_options' dict in the node config.
+# Message limits fit ListInvoices/DescribeGraph/ForwardingHistory of a mainnet sized node. Keepalive
+# pings detect dead connections under long running calls and streams. lnd's gRPC server enforces Go's
+# defaults (grpc.client-ping-min-wait=5m, grpc.client-allow-ping-without-stream=false in newer lnd) and
+# answers more frequent pings, or pings without a call in flight, with GOAWAY too_many_pings.
+DEFAULT_CHANNEL_OPTIONS = {
+    'max_receive_message_length': 200 * 1024 * 1024,
+    'max_send_message_length': 50 * 1024 * 1024,
+    'keepalive_time_ms': 360000,
+    'keepalive_timeout_ms': 20000,
+    'keepalive_permit_without_calls': 0,
+    'compression': None,
+}
+
+GRPC_OPTION_NAMES = {
+    'max_receive_message_length': 'grpc.max_receive_message_length',
+    'max_send_message_length': 'grpc.max_send_message_length',
+    'keepalive_time_ms': 'grpc.keepalive_time_ms',
+    'keepalive_timeout_ms': 'grpc.keepalive_timeout_ms',
+    'keepalive_permit_without_calls': 'grpc.keepalive_permit_without_calls',
+    'http2_max_pings_without_data': 'grpc.http2.max_pings_without_data',
+    'bdp_probe': 'grpc.http2.bdp_probe',
+}
+
+# grpc.Compression names
+COMPRESSION = {
+    None: 'NoCompression',
+    'gzip': 'Gzip',
+    'deflate': 'Deflate',
+}
+
+
+def macaroon_credentials(macaroon):
+    def metadata_callback(context, callback):
+        # for more info see grpc docs
+        callback([("macaroon", macaroon)], None)
+
+    return grpc.metadata_call_credentials(metadata_callback)
+
+
+def channel_credentials(config):
+    """ Build TLS (+ macaroon) channel credentials for a node config """
+    # Due to updated ECDSA generated tls.cert we need to let gprc know that
+    # we need to use that cipher suite otherwise there will be a handhsake
+    # error when we communicate with the lnd rpc server.
+    os.environ["GRPC_SSL_CIPHER_SUITES"] = 'HIGH+ECDSA'
+
+    with open(config['tls_cert'], 'rb') as tls_cert_file:
+        cert_credentials = grpc.ssl_channel_credentials(tls_cert_file.read())
+
+    if config['admin_macaroon']:
+        with open(config['admin_macaroon'], 'rb') as macaroon_file:
+            macaroon = codecs.encode(macaroon_file.read(), 'hex')
+            return grpc.composite_channel_credentials(cert_credentials, macaroon_credentials(macaroon))
+
+    return cert_credentials
+
+
+def channel_options(config):
+    """ gRPC channel arguments and compression for a node config
+
+    :return: ([(grpc_arg, value), ...], grpc.Compression)
+    """
+    options = dict(DEFAULT_CHANNEL_OPTIONS, **config.get('channel_options', {}))
+    compression = options.pop('compression')
+
+    if compression not in COMPRESSION:
+        raise ValueError(f'Unsupported compression: {compression}')
+
+    args = []
+    for name, value in options.items():
+        if value is None:
+            continue
+        if name in GRPC_OPTION_NAMES:
+            args.append((GRPC_OPTION_NAMES[name], value))
+        elif name.startswith('grpc.'):
+            # raw grpc channel argument
+            args.append((name, value))
+        else:
+            raise ValueError(f'Unknown channel option: {name}')
+
+    return args, getattr(grpc.Compression, COMPRESSION[compression])
+
+
+class ChannelPool(object):
+    """ Process wide pool of gRPC channels keyed by (rpc_host, tls_cert, admin_macaroon, channel_options)
+
+        Credentials are built (and cert/macaroon files read) once per key. Up to `size`
+        channels are opened per key, each on its own HTTP/2 connection, and handed out
+        round-robin. Node configs may override the size with a 'pool_size' entry.
+    """
+
+    def __init__(self, size=1):
+        self.size = size
+        self._lock = threading.Lock()
+        self._credentials = {}
+        self._channels = {}
+        self._cycles = {}
+
+    @staticmethod
+    def key(config):
+        options = tuple(sorted(config.get('channel_options', {}).items()))
+        return config['rpc_host'], config['tls_cert'], config.get('admin_macaroon'), options
+
+    def credentials(self, config):
+        key = self.key(config)
+        with self._lock:
+            if key not in self._credentials:
+                self._credentials[key] = channel_credentials(config)
+            return self._credentials[key]
+
+    def get(self, config):
+        """ Next channel for config, opening a new one while the pool is not full """
+        key = self.key(config)
+        size = config.get('pool_size', self.size)
+        credentials = self.credentials(config)
+        options, compression = channel_options(config)
+
+        with self._lock:
+            channels = self._channels.setdefault(key, [])
+            if len(channels) < size:
+                # Local subchannel pool, otherwise grpc shares one connection between equal channels
+                if size > 1:
+                    options.append(('grpc.use_local_subchannel_pool', 1))
+                channel = grpc.secure_channel(config['rpc_host'], credentials, options=options,
+                                              compression=compression)
+                channels.append(channel)
+                logger.debug('POOL %s: opened channel %d/%d', config['rpc_host'], len(channels), size)
+                return channel
+
+            cycle = self._cycles.get(key)
+            if cycle is None:
+                cycle = self._cycles[key] = itertools.cycle(channels)
+            return next(cycle)
+
+    def close(self, config=None):
+        """ Close pooled channels for config, or all of them """
+        with self._lock:
+            keys = [self.key(config)] if config else list(self._channels)
+            for key in keys:
+                for channel in self._channels.pop(key, []):
+                    channel.close()
+                self._cycles.pop(key, None)
+                self._credentials.pop(key, None)
+
+
+default_pool = ChannelPool()
@@ -0,0 +1,301 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import Future
+
+from utils import check_limit, lazy_import, lnd_conf_option
+
+ln = lazy_import('rpc_pb2')
+
+logger = logging.getLogger(__name__)
+
+
+def channel_point_str(channel_point):
+    """ 'txid:index' for an ln.ChannelPoint """
+    if channel_point.HasField('funding_txid_str'):
+        txid = channel_point.funding_txid_str
+    else:
+        # funding_txid_bytes are in internal (reversed) byte order
+        txid = channel_point.funding_txid_bytes[::-1].hex()
+    return f'{txid}:{channel_point.output_index}'
+
+
+def channel_point_from_str(channel_point):
+    """ ln.ChannelPoint for 'txid:index' """
+    txid, output_index = channel_point.split(':')
+    return ln.ChannelPoint(funding_txid_str=txid, output_index=int(output_index))
+
+
+class ChannelIndex(object):
+    """ Local view of a node's open and pending channels
+
+        Channels are indexed by remote pubkey, channel point and chan_id. The view is
+        reloaded (ListChannels and PendingChannels, in parallel) once it is older than `ttl`
+        seconds or after invalidate(); opens and closes made through RpcClient update it in
+        place, so existence checks normally cost no RPC at all.
+    """
+
+    def __init__(self, client, ttl=10):
+        """
+        :type client: lnd.RpcClient
+        """
+        self.client = client
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self.by_pubkey = {}
+        self.by_channel_point = {}
+        self.by_chan_id = {}
+        self.pending_by_pubkey = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def refresh(self):
+        channels_future = self.client.client.ListChannels.future(ln.ListChannelsRequest())
+        pending_future = self.client.client.PendingChannels.future(ln.PendingChannelsRequest())
+        channels = channels_future.result().channels
+        pending = pending_future.result().pending_open_channels
+
+        by_pubkey = defaultdict(list)
+        pending_by_pubkey = defaultdict(set)
+        for channel in channels:
+            by_pubkey[channel.remote_pubkey].append(channel)
+        for pending_channel in pending:
+            pending_by_pubkey[pending_channel.channel.remote_node_pub].add(pending_channel.channel.channel_point)
+
+        with self._lock:
+            self.by_pubkey = dict(by_pubkey)
+            self.pending_by_pubkey = dict(pending_by_pubkey)
+            self.by_channel_point = {channel.channel_point: channel for channel in channels}
+            self.by_chan_id = {channel.chan_id: channel for channel in channels}
+            self._loaded_at = time.monotonic()
+
+    def _fresh(self):
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                self.refresh()
+
+    def has_channel(self, pubkey, pending=True):
+        self._fresh()
+        return pubkey in self.by_pubkey or (pending and pubkey in self.pending_by_pubkey)
+
+    def channels_with(self, pubkey):
+        """ Open ln.Channel list with pubkey """
+        self._fresh()
+        return list(self.by_pubkey.get(pubkey, ()))
+
+    def get(self, channel_point):
+        self._fresh()
+        return self.by_channel_point.get(channel_point)
+
+    def get_by_chan_id(self, chan_id):
+        self._fresh()
+        return self.by_chan_id.get(chan_id)
+
+    def opened(self, pubkey, channel_point):
+        """ Record a channel we just started opening as pending """
+        with self._lock:
+            self.pending_by_pubkey.setdefault(pubkey, set()).add(channel_point_str(channel_point))
+
+    def closed(self, channel_point):
+        """ Forget a channel we just started closing """
+        with self._lock:
+            channel = self.by_channel_point.pop(channel_point, None)
+            if channel is None:
+                return
+            self.by_chan_id.pop(channel.chan_id, None)
+            remaining = [c for c in self.by_pubkey.get(channel.remote_pubkey, ()) if c.channel_point != channel_point]
+            if remaining:
+                self.by_pubkey[channel.remote_pubkey] = remaining
+            else:
+                self.by_pubkey.pop(channel.remote_pubkey, None)
+
+
+class CloseManager(object):
+    """ Closes many channels at once
+
+        Every CloseChannel call is started immediately, so lnd begins every close, and the status
+        streams are followed by at most `workers` daemon threads; streams beyond that wait for a
+        thread to finish one. close() returns a Future per channel point resolved with the closing
+        txid once lnd reports chan_close; the txid from close_pending is kept in pending_txids.
+
+            futures = client.close_manager.close_peer(peer_pubkey)
+            txids = {point: future.result() for point, future in futures.items()}
+    """
+
+    def __init__(self, client, workers=32):
+        """
+        :type client: lnd.RpcClient
+        """
+        self.client = client
+        self.workers = check_limit('workers', workers)
+        self.futures = {}
+        self.pending_txids = {}
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._threads = set()
+        self._threads_lock = threading.Lock()
+
+    def close(self, channel_points, force=False, target_conf=1, sat_per_byte=0):
+        """
+        :param channel_points: 'txid:index' strings
+        :return: {channel_point: Future of the closing txid}
+        """
+        futures = {}
+        for channel_point in channel_points:
+            with self._lock:
+                future = self.futures.get(channel_point)
+                if future is None or (future.done() and future.exception() is not None):
+                    future = self.futures[channel_point] = Future()
+                    self._start(channel_point, future, force, target_conf, sat_per_byte)
+            futures[channel_point] = future
+        return futures
+
+    def close_peer(self, pubkey, force=False, **kwargs):
+        return self.close([channel.channel_point for channel in self.client.channels.channels_with(pubkey)],
+                          force=force, **kwargs)
+
+    def close_all(self, force=False, **kwargs):
+        self.client.channels.invalidate()
+        self.client.channels.refresh()
+        return self.close(list(self.client.channels.by_channel_point), force=force, **kwargs)
+
+    def _start(self, channel_point, future, force, target_conf, sat_per_byte):
+        request = ln.CloseChannelRequest(channel_point=channel_point_from_str(channel_point), force=force,
+                                         target_conf=target_conf, sat_per_byte=sat_per_byte)
+        try:
+            updates = self.client.client.CloseChannel(request)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self.client.channels.closed(channel_point)
+        with self._threads_lock:
+            self._queue.append((channel_point, updates, future))
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f'close-{self.client}', daemon=True)
+                self._threads.add(thread)
+                thread.start()
+
+    def _work(self):
+        """ Follow queued streams until none is left """
+        while True:
+            with self._threads_lock:
+                if not self._queue:
+                    self._threads.discard(threading.current_thread())
+                    return
+                item = self._queue.popleft()
+            self._follow(*item)
+
+    def _follow(self, channel_point, updates, future):
+        try:
+            for update in updates:
+                if update.HasField('close_pending'):
+                    txid = update.close_pending.txid[::-1].hex()
+                    self.pending_txids[channel_point] = txid
+                    logger.info('%s: closing %s in %s', self.client, channel_point, txid)
+                elif update.HasField('chan_close'):
+                    # we stop reading here, end the call so it does not stay in flight
+                    updates.cancel()
+                    future.set_result(update.chan_close.closing_txid[::-1].hex())
+                    return
+            raise RuntimeError(f'CloseChannel stream for {channel_point} ended without chan_close')
+        except Exception as e:
+            updates.cancel()
+            logger.warning('%s: closing %s failed: %s', self.client, channel_point, e)
+            future.set_exception(e)
+
+
+# Futures of one channel being opened: pending resolves with the funding 'txid:index',
+# open with the ln.ChannelPoint once the channel is usable
+ChannelOpening = namedtuple('ChannelOpening', ['pubkey', 'pending', 'open'])
+
+
+class BatchOpener(object):
+    """ Opens channels to many peers at once with the streaming OpenChannel RPC
+
+        Each open runs on its own daemon thread following chan_pending -> chan_open, so
+        callers wait on futures instead of mining and polling. Peers refuse more than their
+        `maxpendingchannels` pending channels from us, so at most `max_pending_per_peer`
+        opens per peer are pending at once (default: maxpendingchannels of lnd.conf).
+
+            openings = client.open_channels([{'node_pubkey_string': pubkey, 'local_funding_amount': 100000}])
+            channel_points = [opening.open.result() for opening in openings]
+    """
+
+    def __init__(self, client, max_pending_per_peer=None, max_pending=None):
+        """
+        :type client: lnd.RpcClient
+        :param max_pending: optional limit of pending opens over all peers
+        """
+        self.client = client
+        if max_pending_per_peer is None:
+            max_pending_per_peer = int(lnd_conf_option('maxpendingchannels', default=1))
+        self.max_pending_per_peer = check_limit('max_pending_per_peer', max_pending_per_peer)
+        self._global_slots = None if max_pending is None else threading.BoundedSemaphore(
+            check_limit('max_pending', max_pending))
+        self._peer_slots = defaultdict(lambda: threading.BoundedSemaphore(self.max_pending_per_peer))
+        self._lock = threading.Lock()
+
+    def open(self, requests):
+        """
+        :param requests: open_channel() kwargs dicts
+        :return: [ChannelOpening] in input order
+        """
+        openings = []
+        # channel_exists_with_node() doesn't know about the opens of this batch yet
+        accepted = set()
+        for kwargs in requests:
+            kwargs = dict(kwargs)
+            force = kwargs.pop('force', None)
+            pubkey = kwargs.get('node_pubkey_string') or kwargs.get('node_pubkey', b'').hex()
+            # the streaming OpenChannel only reads node_pubkey
+            kwargs['node_pubkey'] = bytes.fromhex(pubkey)
+            kwargs.pop('node_pubkey_string', None)
+
+            opening = ChannelOpening(pubkey, Future(), Future())
+            openings.append(opening)
+            if not force and (pubkey in accepted or self.client.channel_exists_with_node(pubkey)):
+                error = AssertionError('Channel already opened')
+                opening.pending.set_exception(error)
+                opening.open.set_exception(error)
+                continue
+            accepted.add(pubkey)
+
+            threading.Thread(target=self._open, args=(opening, ln.OpenChannelRequest(**kwargs)),
+                             name=f'open-{pubkey[:16]}', daemon=True).start()
+        return openings
+
+    def _open(self, opening, request):
+        with self._lock:
+            peer_slots = self._peer_slots[opening.pubkey]
+        slots = [s for s in (peer_slots, self._global_slots) if s is not None]
+        for slot in slots:
+            slot.acquire()
+        updates = None
+        try:
+            updates = self.client.client.OpenChannel(request)
+            for update in updates:
+                if update.HasField('chan_pending'):
+                    channel_point = ln.ChannelPoint(funding_txid_bytes=update.chan_pending.txid,
+                                                    output_index=update.chan_pending.output_index)
+                    self.client.channels.opened(opening.pubkey, channel_point)
+                    opening.pending.set_result(channel_point_str(channel_point))
+                elif update.HasField('chan_open'):
+                    updates.cancel()
+                    self.client.channels.invalidate()
+                    opening.open.set_result(update.chan_open.channel_point)
+                    return
+            raise RuntimeError(f'OpenChannel stream to {opening.pubkey} ended without chan_open')
+        except Exception as e:
+            if updates is not None:
+                updates.cancel()
+            logger.warning('%s: opening channel to %s failed: %s', self.client, opening.pubkey, e)
+            for future in (opening.pending, opening.open):
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            for slot in slots:
+                slot.release()
@@ -0,0 +1,450 @@
+""" Compact in-memory channel graph
+
+A DescribeGraph response of a mainnet node is hundreds of MB of protobuf objects. ChannelGraph keeps
+the same routing information in flat arrays (array module, a few tens of bytes per channel direction):
+
+    - nodes are interned to ints, pubkeys[i] / aliases[i] belong to node i
+    - every channel is two directed edges, 2 * k (node1 -> node2, node1's policy) and 2 * k + 1
+      (node2 -> node1, node2's policy); src, dst, chan_id, capacity, fee_base_msat, fee_rate_ppm,
+      cltv_delta, min_htlc_msat and flags are parallel arrays indexed by edge id
+    - outgoing and incoming adjacency are CSR indexes (offsets + edge ids), rebuilt lazily when
+      nodes or channels were added
+
+        graph = ChannelGraph.fetch(client)
+        for edge in graph.out_edges(graph.node_ids[pubkey]):
+            print(graph.edge(edge))
+"""
+import logging
+import threading
+from array import array
+from collections import Counter, namedtuple
+
+from utils import backoff, lazy_import
+
+grpc = lazy_import('grpc')
+ln = lazy_import('rpc_pb2')
+
+logger = logging.getLogger(__name__)
+
+# edge flags, an edge is usable for routing when its flags are 0
+DISABLED = 1  # the policy is disabled
+NO_POLICY = 2  # no policy announced for this direction yet
+CLOSED = 4  # the channel was closed
+
+# One directed edge, as returned by ChannelGraph.edge()
+Edge = namedtuple('Edge', ['edge_id', 'chan_id', 'source', 'target', 'capacity', 'fee_base_msat', 'fee_rate_ppm',
+                           'cltv_delta', 'min_htlc_msat', 'flags'])
+
+
+class ChannelGraph(object):
+    """ Array backed channel graph, see the module docstring for the layout
+
+        Mutations take `lock`; readers that need a consistent view over several calls should hold it too.
+        `version` changes with every mutation, so readers can cache what they derive from the arrays.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pubkeys = []
+        self.aliases = []
+        self.node_ids = {}
+        self.channels = {}
+
+        self.src = array('I')
+        self.dst = array('I')
+        self.chan_id = array('Q')
+        self.capacity = array('q')
+        self.fee_base_msat = array('q')
+        self.fee_rate_ppm = array('q')
+        self.cltv_delta = array('I')
+        self.min_htlc_msat = array('q')
+        self.flags = array('B')
+
+        self._out = None
+        self._in = None
+        self.version = 0
+
+    @classmethod
+    def fetch(cls, client, include_unannounced=False):
+        """
+        :type client: lnd.RpcClient
+        """
+        graph = cls()
+        graph.load(client.client.DescribeGraph(ln.ChannelGraphRequest(include_unannounced=include_unannounced)))
+        return graph
+
+    @classmethod
+    def from_describe_graph(cls, response):
+        graph = cls()
+        graph.load(response)
+        return graph
+
+    def load(self, response):
+        """ Replace the graph with an ln.ChannelGraph snapshot, in place """
+        with self.lock:
+            self._clear()
+            for node in response.nodes:
+                self.set_node(node.pub_key, node.alias)
+            for edge in response.edges:
+                self.add_channel(edge.channel_id, edge.node1_pub, edge.node2_pub, edge.capacity)
+                if edge.HasField('node1_policy'):
+                    self.set_policy(edge.channel_id, edge.node1_pub, edge.node1_policy)
+                if edge.HasField('node2_policy'):
+                    self.set_policy(edge.channel_id, edge.node2_pub, edge.node2_policy)
+        logger.info('Loaded graph: %d nodes, %d channels, %.1f MB', len(self.pubkeys), len(self.channels),
+                    self.nbytes() / 1024 / 1024)
+        return self
+
+    def _clear(self):
+        del self.pubkeys[:], self.aliases[:]
+        self.node_ids.clear()
+        self.channels.clear()
+        for values in self._arrays():
+            del values[:]
+        self._out = self._in = None
+        self.version += 1
+
+    def _arrays(self):
+        return (self.src, self.dst, self.chan_id, self.capacity, self.fee_base_msat, self.fee_rate_ppm,
+                self.cltv_delta, self.min_htlc_msat, self.flags)
+
+    @property
+    def num_nodes(self):
+        return len(self.pubkeys)
+
+    @property
+    def num_edges(self):
+        return len(self.src)
+
+    def __len__(self):
+        """ Number of channels """
+        return len(self.channels)
+
+    def __contains__(self, chan_id):
+        return chan_id in self.channels
+
+    def nbytes(self):
+        """ Size of the edge arrays and CSR indexes in bytes """
+        indexes = [values for csr in (self._out, self._in) if csr is not None for values in csr]
+        return sum(values.itemsize * len(values) for values in self._arrays() + tuple(indexes))
+
+    def node_id(self, pubkey):
+        """ Interned id of pubkey, added as a new node if unknown """
+        node = self.node_ids.get(pubkey)
+        if node is None:
+            with self.lock:
+                node = self.node_ids.get(pubkey)
+                if node is None:
+                    node = self.node_ids[pubkey] = len(self.pubkeys)
+                    self.pubkeys.append(pubkey)
+                    self.aliases.append('')
+                    self._out = self._in = None
+                    self.version += 1
+        return node
+
+    def set_node(self, pubkey, alias):
+        with self.lock:
+            self.aliases[self.node_id(pubkey)] = alias
+
+    def alias(self, pubkey):
+        node = self.node_ids.get(pubkey)
+        return None if node is None else self.aliases[node]
+
+    def add_channel(self, chan_id, node1_pub, node2_pub, capacity):
+        """ Add a channel without policies (both directions NO_POLICY), or update its capacity """
+        with self.lock:
+            edge = self.channels.get(chan_id)
+            if edge is not None:
+                self.capacity[edge] = self.capacity[edge + 1] = capacity
+                self.flags[edge] &= ~CLOSED
+                self.flags[edge + 1] &= ~CLOSED
+                self.version += 1
+                return edge
+
+            node1, node2 = self.node_id(node1_pub), self.node_id(node2_pub)
+            edge = self.channels[chan_id] = len(self.src)
+            for source, target in ((node1, node2), (node2, node1)):
+                self.src.append(source)
+                self.dst.append(target)
+                self.chan_id.append(chan_id)
+                self.capacity.append(capacity)
+                self.fee_base_msat.append(0)
+                self.fee_rate_ppm.append(0)
+                self.cltv_delta.append(0)
+                self.min_htlc_msat.append(0)
+                self.flags.append(NO_POLICY)
+            self._out = self._in = None
+            self.version += 1
+            return edge
+
+    def edge_id(self, chan_id, source_pubkey):
+        """ Id of the direction of chan_id leaving source_pubkey, None if unknown """
+        edge = self.channels.get(chan_id)
+        if edge is None:
+            return None
+        return edge if self.pubkeys[self.src[edge]] == source_pubkey else edge + 1
+
+    def set_policy(self, chan_id, advertising_node, policy):
+        """ Apply the ln.RoutingPolicy advertising_node announced for chan_id, returns the edge id or None """
+        with self.lock:
+            edge = self.edge_id(chan_id, advertising_node)
+            if edge is None:
+                return None
+            self.fee_base_msat[edge] = policy.fee_base_msat
+            self.fee_rate_ppm[edge] = policy.fee_rate_milli_msat
+            self.cltv_delta[edge] = policy.time_lock_delta
+            self.min_htlc_msat[edge] = policy.min_htlc
+            self.flags[edge] = (self.flags[edge] & CLOSED) | (DISABLED if policy.disabled else 0)
+            self.version += 1
+            return edge
+
+    def close_channel(self, chan_id):
+        """ Mark both directions of chan_id CLOSED, returns False if it was unknown """
+        with self.lock:
+            edge = self.channels.get(chan_id)
+            if edge is None:
+                return False
+            self.flags[edge] |= CLOSED
+            self.flags[edge + 1] |= CLOSED
+            self.version += 1
+            return True
+
+    def channel_states(self):
+        """ {chan_id: routing fields of both directions}, to tell which channels a reload changed """
+        with self.lock:
+            fields = list(zip(self.capacity, self.fee_base_msat, self.fee_rate_ppm, self.cltv_delta, self.min_htlc_msat,
+                              self.flags))
+            return {chan_id: (fields[edge], fields[edge + 1]) for chan_id, edge in self.channels.items()}
+
+    def usable(self, edge):
+        return self.flags[edge] == 0
+
+    def edge(self, edge):
+        """ Edge namedtuple with pubkeys, for inspection """
+        return Edge(edge, self.chan_id[edge], self.pubkeys[self.src[edge]], self.pubkeys[self.dst[edge]],
+                    self.capacity[edge], self.fee_base_msat[edge], self.fee_rate_ppm[edge], self.cltv_delta[edge],
+                    self.min_htlc_msat[edge], self.flags[edge])
+
+    def _csr(self, keys):
+        """ (offsets, edge ids) grouping edge ids by keys[edge], edge ids ascending within a node """
+        counts = Counter(keys)
+        offsets = array('I', [0])
+        for node in range(len(self.pubkeys)):
+            offsets.append(offsets[-1] + counts[node])
+        return offsets, array('I', sorted(range(len(keys)), key=keys.__getitem__))
+
+    def out_index(self):
+        """ Outgoing CSR: edges leaving node n are edges[offsets[n]:offsets[n + 1]] """
+        with self.lock:
+            if self._out is None:
+                self._out = self._csr(self.src)
+            return self._out
+
+    def in_index(self):
+        """ Incoming CSR: edges arriving at node n are edges[offsets[n]:offsets[n + 1]] """
+        with self.lock:
+            if self._in is None:
+                self._in = self._csr(self.dst)
+            return self._in
+
+    def out_edges(self, node):
+        offsets, edges = self.out_index()
+        return edges[offsets[node]:offsets[node + 1]]
+
+    def in_edges(self, node):
+        offsets, edges = self.in_index()
+        return edges[offsets[node]:offsets[node + 1]]
+
+    def channels_of(self, pubkey):
+        """ Edge namedtuples leaving pubkey """
+        node = self.node_ids.get(pubkey)
+        return [] if node is None else [self.edge(edge) for edge in self.out_edges(node)]
+
+    def node_info(self, pubkey):
+        """ ln.NodeInfo like GetNodeInfo from the graph (alias, open channels, capacity), None if unknown
+
+        Addresses, color and last_update are not kept in the graph and left empty.
+        """
+        with self.lock:
+            node = self.node_ids.get(pubkey)
+            if node is None:
+                return None
+            edges = [edge for edge in self.out_edges(node) if not self.flags[edge] & CLOSED]
+            return ln.NodeInfo(node=ln.LightningNode(pub_key=pubkey, alias=self.aliases[node]),
+                               num_channels=len(edges), total_capacity=sum(self.capacity[edge] for edge in edges))
+
+
+class GraphUpdater(object):
+    """ Keeps a ChannelGraph current from SubscribeChannelGraph
+
+        Node updates, channel policy updates and closed channels are applied to the graph in
+        place as they arrive. start() loads a full DescribeGraph snapshot before returning, and
+        the graph is reloaded from a new one every `reconcile_interval` seconds; updates received
+        while a snapshot is downloaded are replayed on top of it. The stream is reopened with
+        jittered backoff.
+
+        Listeners are called with every ln.GraphTopologyUpdate as it is applied (not again when
+        it is replayed), and after a reconcile with an update holding the channels the snapshot
+        changed: directions whose policy or capacity differ as channel_updates, channels no
+        longer in the graph as closed_chans.
+
+            updater = client.graph_updater(listener=lambda update: ...)
+            graph = updater.graph
+            ...
+            updater.stop()
+    """
+
+    def __init__(self, client, graph=None, reconcile_interval=3600, include_unannounced=False,
+                 initial_backoff=0.5, max_backoff=30.0):
+        """
+        :type client: lnd.RpcClient
+        """
+        self.client = client
+        self.graph = graph if graph is not None else ChannelGraph()
+        self.reconcile_interval = reconcile_interval
+        self.include_unannounced = include_unannounced
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.listeners = []
+        self.updates = 0
+        self.reconnects = 0
+        self.reconciles = 0
+
+        # diff reconciles against the graph only once it holds a snapshot: the stream starts before the first
+        # DescribeGraph and writes into the graph meanwhile, so it is not empty by then
+        self._loaded = len(self.graph) > 0
+        self._replay = None
+        self._stopped = threading.Event()
+        self._call = None
+        self._threads = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def start(self):
+        """ Subscribe, load the graph and keep it current, raises if the first DescribeGraph fails """
+        reader = threading.Thread(target=self._read, name=f'graph-{self.client}', daemon=True)
+        self._threads = [reader]
+        reader.start()
+        try:
+            self.reconcile()
+        except Exception:
+            self.stop()
+            raise
+        reconciler = threading.Thread(target=self._reconcile_loop, name=f'graph-reconcile-{self.client}', daemon=True)
+        self._threads.append(reconciler)
+        reconciler.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._call is not None:
+            self._call.cancel()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def apply(self, update):
+        """ Apply an ln.GraphTopologyUpdate to the graph and pass it to the listeners """
+        with self.graph.lock:
+            if self._replay is not None:
+                self._replay.append(update)
+            self._apply(update)
+        self.updates += 1
+        self._notify(update)
+
+    def _apply(self, update):
+        graph = self.graph
+        with graph.lock:
+            for node in update.node_updates:
+                graph.set_node(node.identity_key, node.alias)
+            for channel in update.channel_updates:
+                if channel.chan_id not in graph:
+                    # lnd orders the two ends of a channel by pubkey
+                    node1, node2 = sorted((channel.advertising_node, channel.connecting_node))
+                    graph.add_channel(channel.chan_id, node1, node2, channel.capacity)
+                graph.set_policy(channel.chan_id, channel.advertising_node, channel.routing_policy)
+            for closed in update.closed_chans:
+                graph.close_channel(closed.chan_id)
+
+    def reconcile(self):
+        """ Reload the graph from DescribeGraph, keeping updates that arrive meanwhile
+
+        Listeners get one ln.GraphTopologyUpdate of what changed, except for the first load of an empty
+        graph in start(), which would otherwise report every channel as a protobuf message.
+        """
+        with self.graph.lock:
+            self._replay = []
+        try:
+            snapshot = self.client.client.DescribeGraph(
+                ln.ChannelGraphRequest(include_unannounced=self.include_unannounced))
+            with self.graph.lock:
+                before = self.graph.channel_states() if self._loaded else None
+                self.graph.load(snapshot)
+                replay, self._replay = self._replay, None
+                # listeners saw these when they arrived
+                for update in replay:
+                    self._apply(update)
+                changes = None if before is None else self._changes(before)
+        finally:
+            self._replay = None
+        self._loaded = True
+        self.reconciles += 1
+        if changes is not None and (changes.channel_updates or changes.closed_chans):
+            self._notify(changes)
+
+    def _changes(self, before):
+        """ ln.GraphTopologyUpdate of the channels that differ from `before` (channel_states()) """
+        graph = self.graph
+        after = graph.channel_states()
+        # channels already closed by an update are gone from the snapshot without news
+        changes = ln.GraphTopologyUpdate(closed_chans=[
+            ln.ClosedChannelUpdate(chan_id=chan_id) for chan_id in before.keys() - after.keys()
+            if not before[chan_id][0][-1] & CLOSED])
+        for chan_id, directions in after.items():
+            previous = before.get(chan_id, (None, None))
+            for edge, state, old in zip((graph.channels[chan_id], graph.channels[chan_id] + 1), directions, previous):
+                if state != old:
+                    changes.channel_updates.add(
+                        chan_id=chan_id, capacity=graph.capacity[edge], advertising_node=graph.pubkeys[graph.src[edge]],
+                        connecting_node=graph.pubkeys[graph.dst[edge]], routing_policy=ln.RoutingPolicy(
+                            time_lock_delta=graph.cltv_delta[edge], min_htlc=graph.min_htlc_msat[edge],
+                            fee_base_msat=graph.fee_base_msat[edge], fee_rate_milli_msat=graph.fee_rate_ppm[edge],
+                            disabled=bool(graph.flags[edge] & DISABLED)))
+        return changes
+
+    def _notify(self, update):
+        for listener in self.listeners:
+            try:
+                listener(update)
+            except Exception as e:
+                logger.exception(e)
+
+    def _reconcile_loop(self):
+        # start() did the first reconcile
+        delay = self.reconcile_interval
+        while not self._stopped.wait(delay):
+            try:
+                self.reconcile()
+                delay = self.reconcile_interval
+            except Exception as e:
+                logger.warning('%s: graph reconcile failed: %s', self.client, e)
+                delay = self.initial_backoff * 10
+
+    def _read(self):
+        delays = backoff(self.initial_backoff, self.max_backoff)
+        while not self._stopped.is_set():
+            self._call = self.client.client.SubscribeChannelGraph(ln.GraphTopologySubscription(), wait_for_ready=True)
+            try:
+                for update in self._call:
+                    self.apply(update)
+                    delays = backoff(self.initial_backoff, self.max_backoff)
+            except grpc.RpcError as e:
+                if self._stopped.is_set():
+                    return
+                logger.warning('%s: graph subscription broke (%s: %s)', self.client, e.code(), e.details())
+            except Exception as e:
+                logger.exception(e)
+
+            if self._stopped.wait(next(delays)):
+                return
+            self.reconnects += 1
@@ -0,0 +1,193 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from subscription import InvoiceSubscriber
+from utils import lazy_import
+
+ln = lazy_import('rpc_pb2')
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS invoices (
+    add_index INTEGER PRIMARY KEY,
+    settle_index INTEGER NOT NULL DEFAULT 0,
+    payment_hash TEXT NOT NULL,
+    payment_request TEXT,
+    memo TEXT,
+    value INTEGER,
+    amt_paid_sat INTEGER,
+    state INTEGER,
+    creation_date INTEGER,
+    settle_date INTEGER,
+    expiry INTEGER,
+    invoice BLOB NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS invoices_payment_hash ON invoices (payment_hash);
+CREATE INDEX IF NOT EXISTS invoices_state ON invoices (state, add_index);
+CREATE INDEX IF NOT EXISTS invoices_memo ON invoices (memo);
+CREATE INDEX IF NOT EXISTS invoices_creation_date ON invoices (creation_date);
+CREATE INDEX IF NOT EXISTS invoices_settle_index ON invoices (settle_index);
+'''
+
+# lnd's expiry for invoices created without one
+DEFAULT_EXPIRY = 3600
+
+
+class InvoiceStore(object):
+    """ Local SQLite mirror of a node's invoices
+
+        catch_up() pulls invoices added since the last stored add_index with paginated
+        ListInvoices. Until a settlement has been stored it also refetches from the oldest
+        unexpired OPEN invoice, which may have been settled while the store was offline. start()
+        then follows SubscribeInvoices from the stored add_index and settle_index, reconnecting
+        on errors. Queries only read SQLite and return ln.Invoice messages.
+
+            store = InvoiceStore(RpcClient(BOB_DOCKER), 'bob_invoices.db')
+            store.start()
+            unpaid = store.query(state=ln.Invoice.OPEN)
+    """
+
+    def __init__(self, client, path=':memory:'):
+        """
+        :type client: lnd.RpcClient
+        """
+        self.client = client
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._subscriber = None
+
+    @property
+    def add_index(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(MAX(add_index), 0) FROM invoices').fetchone()[0]
+
+    @property
+    def settle_index(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(MAX(settle_index), 0) FROM invoices').fetchone()[0]
+
+    def oldest_open_add_index(self, now=None):
+        """ add_index of the oldest stored OPEN invoice that has not expired at now, or None """
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._db.execute(
+                'SELECT MIN(add_index) FROM invoices WHERE state = ? '
+                'AND creation_date + CASE WHEN expiry > 0 THEN expiry ELSE ? END > ?',
+                (ln.Invoice.OPEN, DEFAULT_EXPIRY, now)).fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM invoices').fetchone()[0]
+
+    def save(self, invoices):
+        """ Insert or update ln.Invoice messages """
+        rows = [(
+            invoice.add_index,
+            invoice.settle_index,
+            invoice.r_hash.hex(),
+            invoice.payment_request,
+            invoice.memo,
+            invoice.value,
+            invoice.amt_paid_sat,
+            invoice.state,
+            invoice.creation_date,
+            invoice.settle_date,
+            invoice.expiry,
+            invoice.SerializeToString(),
+        ) for invoice in invoices]
+
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def catch_up(self, page_size=1000):
+        """ Store invoices after the last stored add_index, one transaction per page
+
+        lnd only replays settlements to subscribers resuming from a non zero settle_index. While the
+        stored settle_index is 0, unexpired OPEN invoices are fetched again from the oldest one instead.
+        Once it is set, the subscription started by start() replays the settlements after it, and
+        OPEN invoices, which this proto never marks as expired, are not rescanned on every start.
+        """
+        start_index = self.add_index
+        if self.settle_index == 0:
+            oldest_open = self.oldest_open_add_index()
+            if oldest_open is not None:
+                start_index = min(start_index, oldest_open - 1)
+        page = []
+        total = 0
+        for invoice in self.client.iter_invoices(page_size=page_size, start_index=start_index):
+            page.append(invoice)
+            if len(page) == page_size:
+                total += self.save(page)
+                page = []
+        total += self.save(page)
+
+        logger.info('%s: caught up %d invoices after add_index %d', self.client, total, start_index)
+        return total
+
+    def start(self, page_size=1000):
+        """ Catch up, then keep the store current with an InvoiceSubscriber """
+        self.catch_up(page_size=page_size)
+
+        self._subscriber = InvoiceSubscriber(self.client, callback=lambda invoice: self.save([invoice]),
+                                             add_index=self.add_index, settle_index=self.settle_index)
+        self._subscriber.start()
+        return self
+
+    def stop(self):
+        if self._subscriber is not None:
+            self._subscriber.stop()
+            self._subscriber = None
+
+    def close(self):
+        self.stop()
+        self._db.close()
+
+    def get(self, payment_hash):
+        """ Invoice by hex payment hash, or None """
+        with self._lock:
+            row = self._db.execute('SELECT invoice FROM invoices WHERE payment_hash = ?', (payment_hash,)).fetchone()
+        return ln.Invoice.FromString(row[0]) if row else None
+
+    def query(self, state=None, memo_prefix=None, created_from=None, created_to=None, limit=None, newest_first=False):
+        """ Stored invoices matching all given filters, ordered by add_index
+
+        :param state: ln.Invoice.OPEN / ln.Invoice.SETTLED
+        :param memo_prefix: memo starts with (case sensitive, uses the memo index)
+        :param created_from: creation_date >= (unix time)
+        :param created_to: creation_date < (unix time)
+        """
+        where = []
+        params = []
+        if state is not None:
+            where.append('state = ?')
+            params.append(state)
+        if memo_prefix:
+            # range scan instead of LIKE so the memo index is used
+            where.append('memo >= ? AND memo < ?')
+            params += [memo_prefix, memo_prefix + '\U0010ffff']
+        if created_from is not None:
+            where.append('creation_date >= ?')
+            params.append(created_from)
+        if created_to is not None:
+            where.append('creation_date < ?')
+            params.append(created_to)
+
+        sql = 'SELECT invoice FROM invoices'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY add_index' + (' DESC' if newest_first else '')
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [ln.Invoice.FromString(row[0]) for row in rows]
+
+    def unpaid(self, limit=None):
+        return self.query(state=ln.Invoice.OPEN, limit=limit)
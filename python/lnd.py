@@ -1,14 +1,29 @@
-import codecs
+import builtins
 import logging
-import os
-
-import grpc
-
-import rpc_pb2 as ln
-import rpc_pb2_grpc as lnrpc
-
-logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(message)s', )
-logger = logging.getLogger('main')
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+
+import bolt11
+from cache import LRUCache
+from channel_pool import channel_options, default_pool, macaroon_credentials
+from channels import BatchOpener, ChannelIndex, CloseManager, channel_point_from_str, channel_point_str
+from graph import ChannelGraph, GraphUpdater
+from pathfind import DEFAULT_FINAL_CLTV_DELTA, NoRouteError, Pathfinder
+from payments import PaymentExecutor, PaymentStream
+from policy import CallPolicy, PolicyStub
+from route_cache import RouteCache
+from subscription import InvoiceSubscriber
+from utils import check_limit, lazy_import
+
+# Loaded on first use, see utils.lazy_import
+asyncio = lazy_import('asyncio')
+grpc = lazy_import('grpc')
+ln = lazy_import('rpc_pb2')
+lnrpc = lazy_import('rpc_pb2_grpc')
+metrics = lazy_import('metrics')
+
+logger = logging.getLogger(__name__)
 
 FAUCET_DOCKER = {
     'name': 'FAUCET',
@@ -41,47 +56,179 @@ BOB_DOCKER = {
 }
 
 
-class RpcClient(object):
-    identity_pubkey = None
+# Outcome of one item of a batch call, exactly one of response/error is set
+BatchResult = namedtuple('BatchResult', ['response', 'error'])
 
-    def __repr__(self):
-        return self.displayName
+# Outcome of one connect_peers() item, status is one of the PEER_* values, error the lnd message or exception
+PeerResult = namedtuple('PeerResult', ['pubkey', 'host', 'status', 'error'])
 
-    def __init__(self, config):
-        self.displayName = config['name']
+PEER_CONNECTED = 'connected'
+PEER_ALREADY_CONNECTED = 'already connected'
+PEER_UNREACHABLE = 'unreachable'
+PEER_TIMEOUT = 'timeout'
+PEER_INVALID = 'invalid'
 
-        with open(config['tls_cert'], 'rb') as tls_cert_file:
-            cert_credentials = grpc.ssl_channel_credentials(tls_cert_file.read())
 
-            if config['admin_macaroon']:
-                with open(config['admin_macaroon'], 'rb') as macaroon_file:
-                    macaroon = codecs.encode(macaroon_file.read(), 'hex')
-                    macaroon_credentials = self.get_macaroon_credentials(macaroon)
-                    credentials = grpc.composite_channel_credentials(cert_credentials, macaroon_credentials)
-            else:
-                credentials = cert_credentials
+def invoice_request(spec):
+    """ ln.Invoice from an add_invoice() kwargs dict (or an ln.Invoice) """
+    if isinstance(spec, ln.Invoice):
+        return spec
+    return ln.Invoice(memo=spec.get('memo', 'Pay me'), value=spec.get('ammount', 0), expiry=spec.get('expiry', 3600))
 
-            channel = grpc.secure_channel(config["rpc_host"], credentials)
 
-            # Due to updated ECDSA generated tls.cert we need to let gprc know that
-            # we need to use that cipher suite otherwise there will be a handhsake
-            # error when we communicate with the lnd rpc server.
-            os.environ["GRPC_SSL_CIPHER_SUITES"] = 'HIGH+ECDSA'
+def normalize_pay_req(pay_req):
+    """ Canonical BOLT11 string: trimmed, no lightning: prefix, lower case (bech32 is case insensitive) """
+    pay_req = str(pay_req).strip().lower()
+    if pay_req.startswith('lightning:'):
+        pay_req = pay_req[len('lightning:'):]
+    return pay_req
 
-            logger.info(f'CONNECTING TO {config["name"]}: {config["rpc_host"]}')
 
-            self.client = lnrpc.LightningStub(channel)
+def peer_result(pubkey, host, error=None):
+    """ PeerResult classifying a ConnectPeer error (None when it succeeded) """
+    if error is None:
+        return PeerResult(pubkey, host, PEER_CONNECTED, None)
+    if not isinstance(error, grpc.RpcError):
+        return PeerResult(pubkey, host, PEER_INVALID, error)
+    if error.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+        return PeerResult(pubkey, host, PEER_TIMEOUT, error.details())
+    if str(error.details()).startswith('already connected to peer'):
+        return PeerResult(pubkey, host, PEER_ALREADY_CONNECTED, None)
+    return PeerResult(pubkey, host, PEER_UNREACHABLE, error.details())
 
-            self.identity_pubkey = self.getinfo().identity_pubkey
 
-    @staticmethod
-    def get_macaroon_credentials(macaroon):
+def connect_peer_request(pubkey, host, permanent=False):
+    if not pubkey or not host:
+        raise ValueError(f'Pubkey and host are required, got {pubkey}@{host}')
+    return ln.ConnectPeerRequest(addr=ln.LightningAddress(pubkey=pubkey, host=host), perm=permanent)
+
+
+def log_payment(node, invoice_details, response):
+    """ One line per payment; arguments are only formatted when the record is emitted """
+    if response.payment_error:
+        logger.warning('%s: payment %s failed: %s', node, invoice_details.payment_hash, response.payment_error)
+    else:
+        logger.info('%s: paid %s sat to %s, fee %s msat', node, invoice_details.num_satoshis,
+                    invoice_details.destination, response.payment_route.total_fees_msat)
+
+
+def decode_cache(config):
+    """ LRUCache for decoded payment requests, sized by 'decode_cache_size'/'decode_cache_ttl' node config """
+    return LRUCache(maxsize=config.get('decode_cache_size', 10000), ttl=config.get('decode_cache_ttl', 3600))
+
+
+def node_info_cache(config):
+    """ LRUCache for ln.NodeInfo, sized by 'node_info_cache_size'/'node_info_cache_ttl' node config """
+    return LRUCache(maxsize=config.get('node_info_cache_size', 10000), ttl=config.get('node_info_cache_ttl', 600))
 
-        def metadata_callback(context, callback):
-            # for more info see grpc docs
-            callback([("macaroon", macaroon)], None)
 
-        return grpc.metadata_call_credentials(metadata_callback)
+def cached_node_infos(cache, pubkeys, graph=None):
+    """ {pubkey: ln.NodeInfo or None} from the cache and a graph.ChannelGraph, duplicates dropped
+
+    Graph answers are not cached: they lack addresses, color and last_update, which getnode_info() callers rely on.
+    """
+    results = {}
+    for pubkey in pubkeys:
+        if pubkey in results:
+            continue
+        info = cache.get(pubkey)
+        if info is None and graph is not None:
+            info = graph.node_info(pubkey)
+        results[pubkey] = info
+    return results
+
+
+class RpcClient(object):
+    _identity_pubkey = None
+
+    def __repr__(self):
+        return self.displayName
+
+    def __init__(self, config, pool=None, lazy=False):
+        """
+        :param lazy: don't connect on construction, the channel is opened on the first RPC and
+                     identity_pubkey is resolved on first access
+        """
+        self.displayName = config['name']
+        self.config = config
+        self.pool = pool or default_pool
+        self._connect_lock = threading.Lock()
+        self._channel = None
+        self._client = None
+
+        # every call is reported to the 'metrics' sink of the node config (None disables)
+        self.metrics = config.get('metrics', metrics.default_registry)
+        # unary calls get deadlines, retries and hedging from the node's CallPolicy
+        self.policy = CallPolicy.from_config(config)
+        self.decode_cache = decode_cache(config)
+        self.node_info_cache = node_info_cache(config)
+        self.decode_locally = config.get('decode_locally', False)
+        self.channels = ChannelIndex(self, ttl=config.get('channel_index_ttl', 10))
+        self.close_manager = CloseManager(self)
+        # one executor per client, so payments settled by earlier pay_invoices() calls are not paid twice
+        self.payment_executor = PaymentExecutor(self)
+
+        if not lazy:
+            self._identity_pubkey = self.getinfo().identity_pubkey
+
+    def _connect(self):
+        with self._connect_lock:
+            if self._client is None:
+                logger.info(f'CONNECTING TO {self.config["name"]}: {self.config["rpc_host"]}')
+                # Clients of the same node share pooled channels (and TLS/macaroon credentials)
+                channel = self.pool.get(self.config)
+                if self.metrics is not None:
+                    interceptor = metrics.MetricsInterceptor(self.metrics, self.displayName)
+                    channel = grpc.intercept_channel(channel, interceptor)
+                self._channel = channel
+                self._client = PolicyStub(lnrpc.LightningStub(channel), self.policy)
+
+    @property
+    def channel(self):
+        if self._channel is None:
+            self._connect()
+        return self._channel
+
+    @property
+    def client(self):
+        """ PolicyStub over the node's channel, opened on first use """
+        if self._client is None:
+            self._connect()
+        return self._client
+
+    @property
+    def identity_pubkey(self):
+        if self._identity_pubkey is None:
+            info = self.getinfo()
+            if info is not None:
+                self._identity_pubkey = info.identity_pubkey
+        return self._identity_pubkey
+
+    @identity_pubkey.setter
+    def identity_pubkey(self, value):
+        self._identity_pubkey = value
+
+    def warmup(self, timeout=None):
+        """ Connect and resolve identity_pubkey in the background
+
+        :return: concurrent.futures.Future resolved with identity_pubkey
+        """
+        future = Future()
+
+        def connect():
+            try:
+                grpc.channel_ready_future(self.channel).result(timeout=timeout)
+                future.set_result(self.identity_pubkey)
+            except Exception as e:
+                logger.debug('WARMUP %s failed: %r', self.displayName, e)
+                future.set_exception(e)
+
+        threading.Thread(target=connect, name=f'warmup-{self.displayName}', daemon=True).start()
+        return future
+
+    @staticmethod
+    def get_macaroon_credentials(macaroon):
+        return macaroon_credentials(macaroon)
 
     def ping(self):
         try:
@@ -114,12 +261,111 @@ class RpcClient(object):
             logger.exception(e)
 
     def getnode_info(self, pubkey):
+        response = self.node_info_cache.get(pubkey)
+        if response is not None:
+            return response
         try:
             response = self.client.GetNodeInfo(ln.NodeInfoRequest(pub_key=pubkey))
+            self.node_info_cache.set(pubkey, response)
             return response
         except Exception as e:
             logger.exception(e)
 
+    def get_nodes_info(self, pubkeys, concurrency=50, timeout=None, graph=None):
+        """ ln.NodeInfo of many nodes, keeping up to `concurrency` GetNodeInfo calls in flight
+
+        Answers come from node_info_cache first, then from `graph` (a graph.ChannelGraph snapshot, see
+        ChannelGraph.node_info) when given, and only the rest is asked from lnd. Answers from lnd are cached,
+        the partial ones built from `graph` are not.
+
+        :return: {pubkey: ln.NodeInfo}, None for nodes lnd doesn't know or that failed
+        """
+        check_limit('concurrency', concurrency)
+        results = cached_node_infos(self.node_info_cache, pubkeys, graph)
+        missing = [pubkey for pubkey, info in results.items() if info is None]
+        failed = []
+        slots = threading.BoundedSemaphore(concurrency)
+
+        def done(pubkey, future):
+            try:
+                results[pubkey] = future.result()
+                self.node_info_cache.set(pubkey, results[pubkey])
+            except Exception as e:
+                failed.append(pubkey)
+                logger.debug('%s: GetNodeInfo %s failed: %r', self.displayName, pubkey, e)
+            finally:
+                slots.release()
+
+        for pubkey in missing:
+            slots.acquire()
+            try:
+                future = self.client.GetNodeInfo.future(ln.NodeInfoRequest(pub_key=pubkey), timeout=timeout)
+            except Exception as e:
+                failed.append(pubkey)
+                logger.debug('%s: GetNodeInfo %s failed: %r', self.displayName, pubkey, e)
+                slots.release()
+                continue
+            future.add_done_callback(lambda f, p=pubkey: done(p, f))
+
+        for _ in range(concurrency):
+            slots.acquire()
+
+        if failed:
+            logger.warning('%s: no node info for %d/%d nodes', self.displayName, len(failed), len(results))
+        return results
+
+    def describe_graph(self, include_unannounced=False):
+        try:
+            return self.client.DescribeGraph(ln.ChannelGraphRequest(include_unannounced=include_unannounced))
+        except Exception as e:
+            logger.exception(e)
+
+    def channel_graph(self, include_unannounced=False):
+        """ DescribeGraph loaded into a compact graph.ChannelGraph """
+        return ChannelGraph.fetch(self, include_unannounced=include_unannounced)
+
+    def graph_updater(self, graph=None, reconcile_interval=3600, listener=None, **kwargs):
+        """ Start a GraphUpdater keeping `graph` (a new ChannelGraph if None) current, returns once it is loaded
+
+        :param listener: called with every applied ln.GraphTopologyUpdate and the changes found by reconciles
+        :rtype: GraphUpdater
+        """
+        updater = GraphUpdater(self, graph=graph, reconcile_interval=reconcile_interval, **kwargs)
+        if listener is not None:
+            updater.add_listener(listener)
+        return updater.start()
+
+    def pathfinder(self, graph=None, **kwargs):
+        """ Pathfinder from this node over `graph` (fetched with channel_graph() if None)
+
+        :rtype: pathfind.Pathfinder
+        """
+        return Pathfinder(graph if graph is not None else self.channel_graph(), self.identity_pubkey, **kwargs)
+
+    def find_routes(self, pubkey, amt, num_routes=1, final_cltv_delta=DEFAULT_FINAL_CLTV_DELTA, finder=None):
+        """ Up to num_routes ln.Route to pubkey for amt satoshis, found locally instead of with QueryRoutes
+
+        :param final_cltv_delta: the cltv_expiry of the invoice paid
+        :param finder: pathfind.Pathfinder to reuse, a new one over a fresh channel_graph() if None
+        """
+        try:
+            finder = finder if finder is not None else self.pathfinder()
+            height = self.client.GetInfo(ln.GetInfoRequest()).block_height
+            return finder.routes(pubkey, amt * 1000, height, num_routes=num_routes, final_cltv_delta=final_cltv_delta)
+        except NoRouteError as e:
+            logger.debug('FIND ROUTES %s: %s', self.displayName, e)
+            return []
+        except Exception as e:
+            logger.exception(e)
+            return []
+
+    def send_to_route(self, payment_hash, routes):
+        """ SendToRouteSync trying `routes` (ln.Route, e.g. from find_routes) in order """
+        try:
+            return self.client.SendToRouteSync(ln.SendToRouteRequest(payment_hash_string=payment_hash, routes=routes))
+        except Exception as e:
+            logger.exception(e)
+
     def wallet_balance(self):
         try:
             response = self.client.WalletBalance(ln.WalletBalanceRequest())
@@ -147,16 +393,7 @@ class RpcClient(object):
             logger.exception(e)
 
     def channel_exists_with_node(self, pubkey, pending=True):
-        connected_channel_list = list(self.list_channels().channels)
-        connected_pub_keys = set(ch.remote_pubkey for ch in connected_channel_list)
-        pub_keys = connected_pub_keys
-
-        if pending:
-            pending_channels_list = list(self.list_pending_channels().pending_open_channels)
-            pending_pub_keys = set(chan.channel.remote_node_pub for chan in pending_channels_list)
-            pub_keys = pub_keys | pending_pub_keys
-
-        return pubkey in pub_keys
+        return self.channels.has_channel(pubkey, pending=pending)
 
     def add_invoice(self, memo='Pay me', ammount=0, expiry=3600):
         try:
@@ -166,6 +403,43 @@ class RpcClient(object):
         except Exception as e:
             logger.exception(e)
 
+    def add_invoices(self, specs, concurrency=100):
+        """ Create many invoices, keeping up to `concurrency` AddInvoice calls in flight
+
+        :param specs: add_invoice() kwargs dicts or ln.Invoice messages
+        :return: [BatchResult] in input order, failed items carry the error instead of aborting the batch
+        """
+        check_limit('concurrency', concurrency)
+        results = [None] * len(specs)
+        slots = threading.BoundedSemaphore(concurrency)
+
+        def done(index, future):
+            try:
+                results[index] = BatchResult(future.result(), None)
+            except Exception as e:
+                results[index] = BatchResult(None, e)
+            finally:
+                slots.release()
+
+        for index, spec in enumerate(specs):
+            slots.acquire()
+            try:
+                future = self.client.AddInvoice.future(invoice_request(spec))
+            except Exception as e:
+                results[index] = BatchResult(None, e)
+                slots.release()
+                continue
+            future.add_done_callback(lambda f, i=index: done(i, f))
+
+        # wait for the tail of the pipeline
+        for _ in range(concurrency):
+            slots.acquire()
+
+        failed = sum(1 for r in results if r.error is not None)
+        if failed:
+            logger.warning('%s: %d/%d invoices failed', self.displayName, failed, len(specs))
+        return results
+
     def list_invoices(self):
         try:
             response = self.client.ListInvoices(ln.ListInvoiceRequest())
@@ -173,55 +447,114 @@ class RpcClient(object):
         except Exception as e:
             logger.exception(e)
 
-    def decode_pay_request(self, pay_req):
+    def iter_invoices(self, page_size=1000, start_index=0, pending_only=False, reversed=False):
+        """ Lazily walk invoices page by page with ListInvoices index_offset/num_max_invoices
+
+        Unlike list_invoices() only one page is held in memory. RPC errors are raised,
+        not swallowed, so a failed page doesn't look like the end of the list.
+
+        :param start_index: add_index to start after (forward) or before (reversed, 0 = newest)
+        :param reversed: walk from newest to oldest
+        """
+        index_offset = start_index
+        while True:
+            request = ln.ListInvoiceRequest(pending_only=pending_only, index_offset=index_offset,
+                                            num_max_invoices=page_size, reversed=reversed)
+            response = self.client.ListInvoices(request)
+            invoices = response.invoices
+
+            yield from builtins.reversed(invoices) if reversed else invoices
+
+            if len(invoices) < page_size:
+                return
+            index_offset = response.first_index_offset if reversed else response.last_index_offset
+
+    def decode_pay_request(self, pay_req, local=None):
+        """ Decoded ln.PayReq, memoized in decode_cache by normalized payment request
+
+        :param local: decode offline with bolt11, falling back to DecodePayReq if that fails.
+                      Defaults to the 'decode_locally' node config
+        """
+        pay_req = normalize_pay_req(pay_req)
+        response = self.decode_cache.get(pay_req)
+        if response is not None:
+            return response
+
+        if local is None:
+            local = self.decode_locally
+        if local:
+            try:
+                response = bolt11.decode(pay_req)
+                self.decode_cache.set(pay_req, response)
+                return response
+            except ValueError as e:
+                logger.debug('Local decode failed (%s), asking lnd', e)
+
         try:
-            pay_req = pay_req.rstrip()
-            raw_invoice = ln.PayReqString(pay_req=str(pay_req))
+            raw_invoice = ln.PayReqString(pay_req=pay_req)
             response = self.client.DecodePayReq(raw_invoice)
+            self.decode_cache.set(pay_req, response)
             return response
         except Exception as e:
             logger.exception(e)
 
+    @staticmethod
+    def send_request(invoice_details):
+        """ ln.SendRequest paying a decoded ln.PayReq """
+        return ln.SendRequest(
+            dest_string=invoice_details.destination,
+            amt=invoice_details.num_satoshis,
+            payment_hash_string=invoice_details.payment_hash,
+            final_cltv_delta=144  # final_cltv_delta=144 is default for lnd
+        )
+
     def send_payment(self, pay_req):
         invoice_details = self.decode_pay_request(pay_req)
         try:
-            request = ln.SendRequest(
-                dest_string=invoice_details.destination,
-                amt=invoice_details.num_satoshis,
-                payment_hash_string=invoice_details.payment_hash,
-                final_cltv_delta=144  # final_cltv_delta=144 is default for lnd
-            )
-            response = self.client.SendPaymentSync(request)
-            logger.warning(response)
+            response = self.client.SendPaymentSync(self.send_request(invoice_details))
+            log_payment(self.displayName, invoice_details, response)
+            return response
         except Exception as e:
             logger.exception(e)
 
     def pay_invoice(self, pay_req):
-        invoice_details = self.decode_pay_request(pay_req)
-        try:
-            request = ln.SendRequest(
-                dest_string=invoice_details.destination,
-                amt=invoice_details.num_satoshis,
-                payment_hash_string=invoice_details.payment_hash,
-                final_cltv_delta=144  # final_cltv_delta=144 is default for lnd
-            )
-            response = self.client.SendPaymentSync(request)
-            logger.warning(response)
-        except Exception as e:
-            logger.exception(e)
+        return self.send_payment(pay_req)
 
-    def invoice_subscription(self, add_index):
-        try:
-            request = ln.InvoiceSubscription(
-                add_index=add_index,
-                # settle_index= 3,
-            )
-            for response in self.client.SubscribeInvoices(request):
-                print(response)
-                logger.warning(response)
+    def pay_invoices(self, pay_reqs, max_in_flight=50, max_per_destination=5):
+        """ Pay many payment requests concurrently, see PaymentExecutor
 
-        except Exception as e:
-            logger.exception(e)
+        :return: [PaymentResult] in input order
+        """
+        return self.payment_executor.pay(pay_reqs, max_in_flight=max_in_flight, max_per_destination=max_per_destination)
+
+    def route_cache(self, updater=None, **kwargs):
+        """ RouteCache paying repeat destinations over cached QueryRoutes routes
+
+        :param updater: GraphUpdater whose graph updates invalidate cached routes, its graph supplies channel policies
+        :rtype: RouteCache
+        """
+        if updater is not None:
+            kwargs.setdefault('graph', updater.graph)
+        cache = RouteCache(self, **kwargs)
+        if updater is not None:
+            updater.add_listener(cache.on_graph_update)
+        return cache
+
+    def payment_stream(self):
+        """ PaymentStream paying over one open bidirectional SendPayment stream
+
+        :rtype: PaymentStream
+        """
+        return PaymentStream(self)
+
+    def invoice_subscription(self, add_index=0, settle_index=0, callback=None, **kwargs):
+        """ Start an InvoiceSubscriber (reconnecting, resuming, bounded queue) for this node
+
+        :param callback: called with every ln.Invoice update, if None consume the returned subscriber
+        :rtype: InvoiceSubscriber
+        """
+        return InvoiceSubscriber(self, callback=callback, add_index=add_index, settle_index=settle_index,
+                                 **kwargs).start()
 
     def connect_peer(self, pubkey, host, permanent=False):
 
@@ -249,6 +582,45 @@ class RpcClient(object):
 
         return
 
+    def connect_peers(self, peers, concurrency=20, timeout=10, permanent=False):
+        """ Connect to many peers, keeping up to `concurrency` ConnectPeer calls in flight
+
+        Every call has its own `timeout` deadline, so dead hosts can't stall the batch.
+
+        :param peers: (pubkey, host) pairs
+        :return: [PeerResult] in input order
+        """
+        check_limit('concurrency', concurrency)
+        results = [None] * len(peers)
+        slots = threading.BoundedSemaphore(concurrency)
+
+        def done(index, future):
+            try:
+                future.result()
+                results[index] = peer_result(*peers[index])
+            except Exception as e:
+                results[index] = peer_result(*peers[index], error=e)
+            finally:
+                slots.release()
+
+        for index, (pubkey, host) in enumerate(peers):
+            slots.acquire()
+            try:
+                future = self.client.ConnectPeer.future(connect_peer_request(pubkey, host, permanent), timeout=timeout)
+            except Exception as e:
+                results[index] = peer_result(pubkey, host, error=e)
+                slots.release()
+                continue
+            future.add_done_callback(lambda f, i=index: done(i, f))
+
+        for _ in range(concurrency):
+            slots.acquire()
+
+        failed = [r for r in results if r.status not in (PEER_CONNECTED, PEER_ALREADY_CONNECTED)]
+        if failed:
+            logger.warning('%s: %d/%d peers failed to connect', self.displayName, len(failed), len(peers))
+        return results
+
     def disconnect_from_peer(self, pubkey):
         return self.client.DisconnectPeer(
             ln.DisconnectPeerRequest(pub_key=pubkey)
@@ -265,17 +637,25 @@ class RpcClient(object):
         except Exception as e:
             logger.exception(e)
 
+    def open_channels(self, requests, max_pending_per_peer=None, max_pending=None):
+        """ Open channels to many peers concurrently with the streaming OpenChannel RPC
+
+        :param requests: open_channel() kwargs dicts
+        :return: [ChannelOpening] with pending/open futures, see BatchOpener
+        """
+        if max_pending_per_peer is None:
+            max_pending_per_peer = self.config.get('max_pending_channels')
+        return BatchOpener(self, max_pending_per_peer=max_pending_per_peer, max_pending=max_pending).open(requests)
+
     def close_peer_channels(self, peer, force):
-        connected_channel_list = list(self.list_channels().channels)
-        connected_channel_points = set(ch.channel_point for ch in connected_channel_list if ch.remote_pubkey == peer)
-        if connected_channel_points:
-            for channel_point in connected_channel_points:
-                # The outpoint (txid:index) of the funding transaction. With this value, Bob will be able to generate a signature for Alice’s version of the commitment transaction.
-                cp = ln.ChannelPoint(funding_txid_bytes=bytes(channel_point.split(':')[0], 'utf-8'),
-                                     funding_txid_str=u'{}'.format(channel_point.split(':')[0]),
-                                     output_index=int(channel_point.split(':')[1])
-                                     )
-                logger.debug(self.close_channel(channel_point=cp, force=force))
+        """ Close all channels with peer concurrently
+
+        :return: {channel_point: Future of the closing txid}, see CloseManager
+        """
+        return self.close_manager.close_peer(peer, force=force)
+
+    def close_all_channels(self, force):
+        return self.close_manager.close_all(force=force)
 
     def close_channel(self, channel_point, force):
         try:
@@ -287,17 +667,19 @@ class RpcClient(object):
                 # sat_per_byte=<int64>
             )
             response = self.client.CloseChannel(request)
+            self.channels.closed(channel_point_str(channel_point))
             return response
         except Exception as e:
             logger.exception(e)
 
     def open_channel(self, **kwargs):
-        if not self.channel_exists_with_node(kwargs.get('node_pubkey_string')) or kwargs.get('force'):
+        force = kwargs.pop('force', None)
+        pubkey = kwargs.get('node_pubkey_string') or kwargs.get('node_pubkey', b'').hex()
+        if force or not self.channel_exists_with_node(pubkey):
             try:
-                if kwargs.get('force') is not None:
-                    del kwargs['force']
                 request = ln.OpenChannelRequest(**kwargs)
                 response = self.client.OpenChannelSync(request)
+                self.channels.opened(pubkey, response)
                 return response
             except Exception as e:
                 logger.exception(e)
@@ -310,3 +692,328 @@ class RpcClient(object):
             return response
         except Exception as e:
             logger.exception(e)
+
+
+class AsyncRpcClient(object):
+    """ asyncio (grpc.aio) counterpart of RpcClient
+
+        Unary calls are coroutines, streaming calls are async iterators. A single
+        event loop can keep many calls in flight over one HTTP/2 channel:
+
+            async with AsyncRpcClient(FAUCET_DOCKER) as client:
+                invoices = await asyncio.gather(*(client.add_invoice(ammount=i) for i in range(1, 1000)))
+    """
+    identity_pubkey = None
+
+    def __repr__(self):
+        return self.displayName
+
+    def __init__(self, config, pool=None):
+        self.displayName = config['name']
+
+        # aio channels are bound to an event loop, so only the credentials are pooled
+        options, compression = channel_options(config)
+        self.channel = grpc.aio.secure_channel(config["rpc_host"], (pool or default_pool).credentials(config),
+                                          options=options, compression=compression)
+
+        logger.info(f'CONNECTING TO {config["name"]}: {config["rpc_host"]} (asyncio)')
+
+        self.client = lnrpc.LightningStub(self.channel)
+        self.decode_cache = decode_cache(config)
+        self.node_info_cache = node_info_cache(config)
+        self.decode_locally = config.get('decode_locally', False)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def connect(self):
+        """ Wait for the channel and populate identity_pubkey """
+        info = await self.getinfo()
+        if info is not None:
+            self.identity_pubkey = info.identity_pubkey
+        return self
+
+    async def close(self):
+        await self.channel.close()
+
+    async def ping(self):
+        try:
+            await self.client.GetInfo(ln.GetInfoRequest())
+            return True
+        except Exception as e:
+            logger.exception(e)
+            return False
+
+    async def list_peers(self):
+        try:
+            response = await self.client.ListPeers(ln.ListPeersRequest())
+            return [p.pub_key for p in response.peers]
+        except Exception as e:
+            logger.exception(e)
+            return []
+
+    async def address(self):
+        try:
+            response = await self.client.NewAddress(ln.NewAddressRequest())
+            return response
+        except Exception as e:
+            logger.exception(e)
+
+    async def getinfo(self):
+        try:
+            response = await self.client.GetInfo(ln.GetInfoRequest())
+            return response
+        except Exception as e:
+            logger.exception(e)
+
+    async def getnode_info(self, pubkey):
+        response = self.node_info_cache.get(pubkey)
+        if response is not None:
+            return response
+        try:
+            response = await self.client.GetNodeInfo(ln.NodeInfoRequest(pub_key=pubkey))
+            self.node_info_cache.set(pubkey, response)
+            return response
+        except Exception as e:
+            logger.exception(e)
+
+    async def get_nodes_info(self, pubkeys, concurrency=50, timeout=None, graph=None):
+        """ asyncio version of RpcClient.get_nodes_info """
+        results = cached_node_infos(self.node_info_cache, pubkeys, graph)
+        slots = asyncio.Semaphore(check_limit('concurrency', concurrency))
+
+        async def fetch(pubkey):
+            async with slots:
+                try:
+                    results[pubkey] = await self.client.GetNodeInfo(ln.NodeInfoRequest(pub_key=pubkey), timeout=timeout)
+                    self.node_info_cache.set(pubkey, results[pubkey])
+                except Exception as e:
+                    logger.debug('%s: GetNodeInfo %s failed: %r', self.displayName, pubkey, e)
+
+        await asyncio.gather(*(fetch(pubkey) for pubkey, info in list(results.items()) if info is None))
+        return results
+
+    async def wallet_balance(self):
+        try:
+            response = await self.client.WalletBalance(ln.WalletBalanceRequest())
+            return {
+                'node': self.displayName,
+                'total_balance': response.total_balance,
+                'confirmed_balance': response.confirmed_balance,
+                'unconfirmed_balance': response.unconfirmed_balance,
+            }
+        except Exception as e:
+            logger.exception(e)
+
+    async def list_channels(self):
+        try:
+            response = await self.client.ListChannels(ln.ListChannelsRequest())
+            return response
+        except Exception as e:
+            logger.exception(e)
+
+    async def list_pending_channels(self):
+        try:
+            response = await self.client.PendingChannels(ln.PendingChannelsRequest())
+            return response
+        except Exception as e:
+            logger.exception(e)
+
+    async def channel_exists_with_node(self, pubkey, pending=True):
+        if pending:
+            channels, pending_channels = await asyncio.gather(self.list_channels(), self.list_pending_channels())
+        else:
+            channels, pending_channels = await self.list_channels(), None
+
+        pub_keys = set(ch.remote_pubkey for ch in channels.channels)
+
+        if pending_channels is not None:
+            pub_keys |= set(chan.channel.remote_node_pub for chan in pending_channels.pending_open_channels)
+
+        return pubkey in pub_keys
+
+    async def add_invoice(self, memo='Pay me', ammount=0, expiry=3600):
+        try:
+            invoice_req = ln.Invoice(memo=memo, value=ammount, expiry=expiry)
+            response = await self.client.AddInvoice(invoice_req)
+            return response
+        except Exception as e:
+            logger.exception(e)
+
+    async def add_invoices(self, specs, concurrency=100):
+        """ asyncio version of RpcClient.add_invoices """
+        slots = asyncio.Semaphore(check_limit('concurrency', concurrency))
+
+        async def add(spec):
+            async with slots:
+                try:
+                    return BatchResult(await self.client.AddInvoice(invoice_request(spec)), None)
+                except Exception as e:
+                    return BatchResult(None, e)
+
+        return await asyncio.gather(*(add(spec) for spec in specs))
+
+    async def list_invoices(self):
+        try:
+            response = await self.client.ListInvoices(ln.ListInvoiceRequest())
+            return response
+        except Exception as e:
+            logger.exception(e)
+
+    async def iter_invoices(self, page_size=1000, start_index=0, pending_only=False, reversed=False):
+        """ Async iterator version of RpcClient.iter_invoices """
+        index_offset = start_index
+        while True:
+            request = ln.ListInvoiceRequest(pending_only=pending_only, index_offset=index_offset,
+                                            num_max_invoices=page_size, reversed=reversed)
+            response = await self.client.ListInvoices(request)
+            invoices = response.invoices
+
+            for invoice in (builtins.reversed(invoices) if reversed else invoices):
+                yield invoice
+
+            if len(invoices) < page_size:
+                return
+            index_offset = response.first_index_offset if reversed else response.last_index_offset
+
+    async def decode_pay_request(self, pay_req, local=None):
+        pay_req = normalize_pay_req(pay_req)
+        response = self.decode_cache.get(pay_req)
+        if response is not None:
+            return response
+
+        if local is None:
+            local = self.decode_locally
+        if local:
+            try:
+                response = bolt11.decode(pay_req)
+                self.decode_cache.set(pay_req, response)
+                return response
+            except ValueError as e:
+                logger.debug('Local decode failed (%s), asking lnd', e)
+
+        try:
+            raw_invoice = ln.PayReqString(pay_req=pay_req)
+            response = await self.client.DecodePayReq(raw_invoice)
+            self.decode_cache.set(pay_req, response)
+            return response
+        except Exception as e:
+            logger.exception(e)
+
+    async def send_payment(self, pay_req):
+        invoice_details = await self.decode_pay_request(pay_req)
+        try:
+            response = await self.client.SendPaymentSync(RpcClient.send_request(invoice_details))
+            log_payment(self.displayName, invoice_details, response)
+            return response
+        except Exception as e:
+            logger.exception(e)
+
+    async def pay_invoice(self, pay_req):
+        return await self.send_payment(pay_req)
+
+    async def invoice_subscription(self, add_index=0, settle_index=0):
+        """ Async iterator over SubscribeInvoices updates """
+        request = ln.InvoiceSubscription(add_index=add_index, settle_index=settle_index)
+        async for response in self.client.SubscribeInvoices(request):
+            yield response
+
+    async def connect_peer(self, pubkey, host, permanent=False):
+
+        assert host, "Host is empty."
+        assert pubkey, "Pubkey is empty."
+
+        request = ln.ConnectPeerRequest(addr=ln.LightningAddress(pubkey=pubkey, host=host), perm=permanent)
+
+        try:
+            response = await self.client.ConnectPeer(request)
+            return response
+        except grpc.aio.AioRpcError as e:
+            if str(e.details()).startswith('already connected to peer'):
+                pass
+            else:
+                raise AssertionError(f'Can\'t connect to {host}! {e.details()}')
+
+    async def connect_peers(self, peers, concurrency=20, timeout=10, permanent=False):
+        """ asyncio version of RpcClient.connect_peers """
+        slots = asyncio.Semaphore(check_limit('concurrency', concurrency))
+
+        async def connect(pubkey, host):
+            async with slots:
+                try:
+                    await self.client.ConnectPeer(connect_peer_request(pubkey, host, permanent), timeout=timeout)
+                    return peer_result(pubkey, host)
+                except Exception as e:
+                    return peer_result(pubkey, host, error=e)
+
+        return await asyncio.gather(*(connect(pubkey, host) for pubkey, host in peers))
+
+    async def disconnect_from_peer(self, pubkey):
+        return await self.client.DisconnectPeer(
+            ln.DisconnectPeerRequest(pub_key=pubkey)
+        )
+
+    async def channel_balance(self):
+        try:
+            response = await self.client.ChannelBalance(ln.ChannelBalanceRequest())
+            return {
+                'node': self.displayName,
+                'balance': response.balance,
+                'pending_open_balance': response.pending_open_balance
+            }
+        except Exception as e:
+            logger.exception(e)
+
+    async def close_peer_channels(self, peer, force):
+        """ Close all channels with peer, returns the first status update of every close """
+        channels = await self.list_channels()
+        channel_points = set(ch.channel_point for ch in channels.channels if ch.remote_pubkey == peer)
+
+        async def first_update(channel_point):
+            # lnd keeps closing after the stream is cancelled
+            call = self.client.CloseChannel(ln.CloseChannelRequest(
+                channel_point=channel_point_from_str(channel_point), force=force, target_conf=1))
+            try:
+                async for update in call:
+                    return update
+            finally:
+                call.cancel()
+
+        return await asyncio.gather(*(first_update(cp) for cp in channel_points))
+
+    async def close_channel(self, channel_point, force):
+        """ Async iterator over CloseChannel status updates """
+        request = ln.CloseChannelRequest(
+            channel_point=channel_point,
+            force=force,
+            target_conf=1,
+        )
+        call = self.client.CloseChannel(request)
+        try:
+            async for update in call:
+                yield update
+        finally:
+            call.cancel()
+
+    async def open_channel(self, **kwargs):
+        force = kwargs.pop('force', None)
+        if force or not await self.channel_exists_with_node(kwargs.get('node_pubkey_string')):
+            try:
+                request = ln.OpenChannelRequest(**kwargs)
+                response = await self.client.OpenChannelSync(request)
+                return response
+            except Exception as e:
+                logger.exception(e)
+        else:
+            raise AssertionError('Channel already opened')
+
+    async def stop(self):
+        try:
+            response = await self.client.StopDaemon(ln.StopRequest())
+            return response
+        except Exception as e:
+            logger.exception(e)
@@ -0,0 +1,282 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import lazy_import
+
+grpc = lazy_import('grpc')
+
+logger = logging.getLogger(__name__)
+
+# Latency histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram(object):
+    """ Cumulative-on-export histogram, not thread safe on its own (MetricsRegistry locks) """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ [(upper bound, observations <= bound)], the last bound is '+Inf' """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q quantile """
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+
+
+class MetricsRegistry(object):
+    """ In-process metrics sink: per (node, method) latency histograms, status codes, byte counts and in-flight calls
+
+        Any object with started(node, method) and finished(node, method, code, seconds, request_bytes,
+        response_bytes) can replace it as the sink of a MetricsInterceptor.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(self.buckets))
+        self.codes = defaultdict(int)
+        self.request_bytes = defaultdict(int)
+        self.response_bytes = defaultdict(int)
+        self.in_flight = defaultdict(int)
+
+    def started(self, node, method):
+        with self._lock:
+            self.in_flight[node, method] += 1
+
+    def finished(self, node, method, code, seconds, request_bytes, response_bytes):
+        with self._lock:
+            self.in_flight[node, method] -= 1
+            self.latency[node, method].observe(seconds)
+            self.codes[node, method, code] += 1
+            self.request_bytes[node, method] += request_bytes
+            self.response_bytes[node, method] += response_bytes
+
+    def clear(self):
+        with self._lock:
+            self.latency.clear()
+            self.codes.clear()
+            self.request_bytes.clear()
+            self.response_bytes.clear()
+            self.in_flight.clear()
+
+    def summary(self):
+        """ {(node, method): {'calls', 'errors', 'p50', 'p99', 'mean', 'in_flight'}}, slowest (mean) first """
+        with self._lock:
+            rows = {}
+            for key, histogram in self.latency.items():
+                errors = sum(count for (node, method, code), count in self.codes.items()
+                             if (node, method) == key and code != 'OK')
+                rows[key] = {'calls': histogram.count, 'errors': errors, 'p50': histogram.quantile(0.5),
+                             'p99': histogram.quantile(0.99), 'mean': histogram.sum / histogram.count,
+                             'in_flight': self.in_flight[key]}
+        return dict(sorted(rows.items(), key=lambda row: -row[1]['mean']))
+
+    def prometheus(self):
+        """ Metrics in the Prometheus text exposition format """
+        lines = []
+        with self._lock:
+            lines += ['# HELP lnd_rpc_latency_seconds lnd RPC latency',
+                      '# TYPE lnd_rpc_latency_seconds histogram']
+            for (node, method), histogram in sorted(self.latency.items()):
+                labels = f'node="{node}",method="{method}"'
+                for bound, total in histogram.cumulative():
+                    lines.append(f'lnd_rpc_latency_seconds_bucket{{{labels},le="{bound}"}} {total}')
+                lines.append(f'lnd_rpc_latency_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'lnd_rpc_latency_seconds_count{{{labels}}} {histogram.count}')
+
+            lines += ['# HELP lnd_rpc_calls_total Finished lnd RPCs by status code',
+                      '# TYPE lnd_rpc_calls_total counter']
+            for (node, method, code), count in sorted(self.codes.items()):
+                lines.append(f'lnd_rpc_calls_total{{node="{node}",method="{method}",code="{code}"}} {count}')
+
+            for name, values in (('request', self.request_bytes), ('response', self.response_bytes)):
+                lines += [f'# HELP lnd_rpc_{name}_bytes_total Serialized {name} message bytes',
+                          f'# TYPE lnd_rpc_{name}_bytes_total counter']
+                for (node, method), count in sorted(values.items()):
+                    lines.append(f'lnd_rpc_{name}_bytes_total{{node="{node}",method="{method}"}} {count}')
+
+            lines += ['# HELP lnd_rpc_in_flight lnd RPCs started and not finished, open streams included',
+                      '# TYPE lnd_rpc_in_flight gauge']
+            for (node, method), count in sorted(self.in_flight.items()):
+                lines.append(f'lnd_rpc_in_flight{{node="{node}",method="{method}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+default_registry = MetricsRegistry()
+
+
+def start_http_server(port, registry=default_registry, host=''):
+    """ Serve registry.prometheus() on http://host:port/metrics from a daemon thread """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name=f'metrics-{port}', daemon=True).start()
+    return server
+
+
+def _method(client_call_details):
+    # '/lnrpc.Lightning/GetInfo' -> 'GetInfo'
+    return client_call_details.method.rsplit('/', 1)[-1]
+
+
+def _code(call):
+    code = call.code()
+    return code.name if code is not None else 'UNKNOWN'
+
+
+class _CountingIterator(object):
+    """ Message iterator counting serialized bytes, used on both directions of streams """
+
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self.bytes = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        message = next(self._iterator)
+        self.bytes += message.ByteSize()
+        return message
+
+
+class _CountingCall(_CountingIterator):
+    """ Response stream of a call, counting received bytes and forwarding everything else to the call
+
+        finish(call) runs once, when the call terminates or the consumer reaches the end of the
+        stream, whichever comes first. Consumers may stop reading early (OpenChannel, CloseChannel),
+        so waiting for the end could leave the call in flight forever; messages still buffered when
+        the call terminates are not counted.
+    """
+
+    def __init__(self, call, finish):
+        super(_CountingCall, self).__init__(call)
+        self._finish = finish
+        self._finished = False
+        self._lock = threading.Lock()
+        call.add_done_callback(lambda _: self._done())
+
+    def __next__(self):
+        try:
+            return super(_CountingCall, self).__next__()
+        except BaseException:
+            self._done()
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self._iterator, name)
+
+    def _done(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self._finish(self)
+
+
+class MetricsInterceptor(object):
+    """ Reports every call on the channel to a metrics sink
+
+            channel = grpc.intercept_channel(channel, MetricsInterceptor(default_registry, 'FAUCET'))
+    """
+
+    _registered = False
+
+    def __init__(self, sink=default_registry, node=''):
+        self.sink = sink
+        self.node = node
+        if not MetricsInterceptor._registered:
+            # registered rather than subclassed, so importing metrics doesn't import grpc. register() is
+            # idempotent, so two first instances racing here is harmless
+            for interceptor in (grpc.UnaryUnaryClientInterceptor, grpc.UnaryStreamClientInterceptor,
+                                grpc.StreamUnaryClientInterceptor, grpc.StreamStreamClientInterceptor):
+                interceptor.register(MetricsInterceptor)
+            MetricsInterceptor._registered = True
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        method = _method(client_call_details)
+        started = time.perf_counter()
+        self.sink.started(self.node, method)
+        call = continuation(client_call_details, request)
+
+        def done(call):
+            code = _code(call)
+            response_bytes = call.result().ByteSize() if code == 'OK' else 0
+            self.sink.finished(self.node, method, code, time.perf_counter() - started, request.ByteSize(),
+                               response_bytes)
+
+        call.add_done_callback(done)
+        return call
+
+    def intercept_unary_stream(self, continuation, client_call_details, request):
+        method = _method(client_call_details)
+        started = time.perf_counter()
+        self.sink.started(self.node, method)
+        return _CountingCall(continuation(client_call_details, request),
+                             lambda call: self.sink.finished(self.node, method, _code(call),
+                                                             time.perf_counter() - started, request.ByteSize(),
+                                                             call.bytes))
+
+    def intercept_stream_unary(self, continuation, client_call_details, request_iterator):
+        method = _method(client_call_details)
+        started = time.perf_counter()
+        self.sink.started(self.node, method)
+        requests = _CountingIterator(iter(request_iterator))
+        call = continuation(client_call_details, requests)
+
+        def done(call):
+            code = _code(call)
+            response_bytes = call.result().ByteSize() if code == 'OK' else 0
+            self.sink.finished(self.node, method, code, time.perf_counter() - started, requests.bytes,
+                               response_bytes)
+
+        call.add_done_callback(done)
+        return call
+
+    def intercept_stream_stream(self, continuation, client_call_details, request_iterator):
+        method = _method(client_call_details)
+        started = time.perf_counter()
+        self.sink.started(self.node, method)
+        requests = _CountingIterator(iter(request_iterator))
+        return _CountingCall(continuation(client_call_details, requests),
+                             lambda call: self.sink.finished(self.node, method, _code(call),
+                                                             time.perf_counter() - started, requests.bytes,
+                                                             call.bytes))
@@ -0,0 +1,279 @@
+import logging
+import queue
+import threading
+from collections import namedtuple, OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cache import LRUCache
+from utils import check_limit
+
+logger = logging.getLogger(__name__)
+# one record per payment, see utils.configure_logging(sample_every=...)
+events = logging.getLogger(f'{__name__}.events')
+
+# preimage is hex, route the ln.Route taken, error a payment_error string or exception
+PaymentResult = namedtuple('PaymentResult', ['payment_request', 'payment_hash', 'preimage', 'route', 'fee_msat',
+                                             'error'])
+
+# Decoded payment sent on a PaymentStream, stream is the request queue it was sent on
+StreamPayment = namedtuple('StreamPayment', ['details', 'stream'])
+
+# lnd's limit for a single payment (2^32 - 1 msat)
+MAX_PAYMENT_SAT = 4294967
+
+
+def payment_error(details):
+    """ Why lnd would reject paying a decoded ln.PayReq before tracking it, or None
+
+    lnd answers such requests on the SendPayment stream without a payment hash, so they can't be
+    matched to their caller and are failed before they are sent.
+    """
+    if len(details.destination) != 66:
+        return f'Invalid destination {details.destination!r}'
+    if len(details.payment_hash) != 64:
+        return f'Invalid payment hash {details.payment_hash!r}'
+    if details.num_satoshis <= 0:
+        return 'Amount must be specified when paying a zero amount invoice'
+    if details.num_satoshis > MAX_PAYMENT_SAT:
+        return f'Payment of {details.num_satoshis} sat exceeds the maximum of {MAX_PAYMENT_SAT} sat'
+    return None
+
+
+class PaymentExecutor(object):
+    """ Pays batches of payment requests concurrently
+
+        Payments are issued with SendPaymentSync futures, so in-flight payments cost no threads.
+        At most `max_in_flight` payments run at once and at most `max_per_destination` to any
+        single destination node. Requests are deduplicated by payment hash, within a batch and
+        against payments this executor already completed successfully.
+
+            executor = PaymentExecutor(RpcClient(ALICE_DOCKER), max_in_flight=100)
+            results = executor.pay(payment_requests)
+    """
+
+    def __init__(self, client, max_in_flight=50, max_per_destination=5, decode_workers=16, paid_cache_size=100000):
+        """
+        :type client: lnd.RpcClient
+        """
+        self.client = client
+        self.max_in_flight = check_limit('max_in_flight', max_in_flight)
+        self.max_per_destination = check_limit('max_per_destination', max_per_destination)
+        self.decode_workers = check_limit('decode_workers', decode_workers)
+        self._paid = LRUCache(maxsize=paid_cache_size)
+
+    def decode(self, pay_reqs):
+        """ ln.PayReq (or None) for every payment request, decoded in parallel, each distinct one once """
+        unique = list(dict.fromkeys(pay_reqs))
+        with ThreadPoolExecutor(max_workers=self.decode_workers) as pool:
+            decoded = dict(zip(unique, pool.map(self.client.decode_pay_request, unique)))
+        return [decoded[pay_req] for pay_req in pay_reqs]
+
+    def pay(self, pay_reqs, max_in_flight=None, max_per_destination=None):
+        """
+        :param max_in_flight: override the executor's limit for this batch
+        :param max_per_destination: override the executor's limit for this batch
+        :return: [PaymentResult] in input order
+        """
+        if max_in_flight is None:
+            max_in_flight = self.max_in_flight
+        if max_per_destination is None:
+            max_per_destination = self.max_per_destination
+        check_limit('max_in_flight', max_in_flight)
+        check_limit('max_per_destination', max_per_destination)
+        results = [None] * len(pay_reqs)
+        payments = OrderedDict()
+
+        for index, (pay_req, details) in enumerate(zip(pay_reqs, self.decode(pay_reqs))):
+            paid = self._paid.get(details.payment_hash) if details is not None else None
+            if details is None:
+                results[index] = PaymentResult(pay_req, None, None, None, None, 'Can\'t decode payment request')
+            elif paid is not None:
+                results[index] = paid._replace(payment_request=pay_req)
+            else:
+                payments.setdefault(details.payment_hash, (pay_req, details, []))[2].append(index)
+
+        # per destination queues, so a busy destination doesn't hold back the others
+        pending = OrderedDict()
+        for payment in payments.values():
+            pending.setdefault(payment[1].destination, deque()).append(payment)
+        in_flight = defaultdict(int)
+        done = threading.Condition()
+
+        def finish(pay_req, details, indexes, future):
+            try:
+                response = future.result()
+                if response.payment_error:
+                    result = PaymentResult(pay_req, details.payment_hash, None, response.payment_route, None,
+                                           response.payment_error)
+                else:
+                    result = PaymentResult(pay_req, details.payment_hash, response.payment_preimage.hex(),
+                                           response.payment_route, response.payment_route.total_fees_msat, None)
+                    self._paid.set(details.payment_hash, result)
+            except Exception as e:
+                result = PaymentResult(pay_req, details.payment_hash, None, None, None, e)
+
+            events.debug('%s: payment %s %s', self.client, details.payment_hash,
+                         'failed' if result.error is not None else 'settled')
+            with done:
+                for index in indexes:
+                    results[index] = result._replace(payment_request=pay_reqs[index])
+                in_flight[None] -= 1
+                in_flight[details.destination] -= 1
+                done.notify()
+
+        with done:
+            while True:
+                for destination in list(pending):
+                    waiting = pending[destination]
+                    while waiting and in_flight[None] < max_in_flight and in_flight[destination] < max_per_destination:
+                        payment = waiting.popleft()
+                        in_flight[None] += 1
+                        in_flight[destination] += 1
+                        try:
+                            future = self.client.client.SendPaymentSync.future(self.client.send_request(payment[1]))
+                        except Exception as e:
+                            # failed before it was sent, finish() records it and frees its slots (done is reentrant)
+                            future = Future()
+                            future.set_exception(e)
+                        future.add_done_callback(lambda f, p=payment: finish(*p, f))
+                    if not waiting:
+                        del pending[destination]
+
+                if not pending and not in_flight[None]:
+                    break
+                done.wait()
+
+        failed = sum(1 for result in results if result.error is not None)
+        logger.info('%s: paid %d/%d payment requests', self.client, len(results) - failed, len(results))
+        return results
+
+
+class PaymentStream(object):
+    """ Pays over one long lived bidirectional SendPayment stream
+
+        SendRequests are fed into a single open stream and responses are matched back to the
+        caller's future by payment hash, so a payout burst pays no per-payment RPC setup.
+        Requests lnd would reject without echoing their hash are failed locally instead
+        (see payment_error), so every response can be matched by hash.
+        The stream is opened on first use and reopened after it breaks; payments outstanding
+        when it breaks fail with the stream error.
+
+            with PaymentStream(RpcClient(ALICE_DOCKER)) as stream:
+                results = stream.pay(payment_requests)
+    """
+
+    _closed = object()
+
+    def __init__(self, client):
+        """
+        :type client: lnd.RpcClient
+        """
+        self.client = client
+        self._lock = threading.Lock()
+        self._requests = None
+        self._futures = OrderedDict()
+        self._reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _open(self):
+        requests = self._requests = queue.Queue()
+
+        def request_iterator():
+            while True:
+                request = requests.get()
+                if request is self._closed:
+                    return
+                yield request
+
+        call = self.client.client.SendPayment(request_iterator())
+        self._reader = threading.Thread(target=self._read, args=(call, requests), name=f'send-payment-{self.client}',
+                                        daemon=True)
+        self._reader.start()
+
+    def _read(self, call, requests):
+        try:
+            for response in call:
+                payment_hash = response.payment_hash.hex()
+                with self._lock:
+                    if payment_hash not in self._futures:
+                        # never guess the pairing, that would fail another caller's (maybe settled) payment
+                        logger.warning('%s: unmatched SendPayment response %r: %s', self.client, payment_hash,
+                                       response.payment_error)
+                        continue
+                    payment, future = self._futures.pop(payment_hash)
+                events.debug('%s: payment %s %s', self.client, payment_hash, response.payment_error or 'settled')
+                future.set_result(response)
+            error = RuntimeError('SendPayment stream closed')
+        except Exception as e:
+            error = e
+
+        with self._lock:
+            if self._requests is requests:
+                self._requests = None
+            # only payments sent on this stream are lost, fail them
+            failed = [payment_hash for payment_hash, (payment, future) in self._futures.items()
+                      if payment.stream is requests]
+            for payment_hash in failed:
+                self._futures.pop(payment_hash)[1].set_exception(error)
+        if failed:
+            logger.warning('%s: SendPayment stream broke with %d payments in flight: %s', self.client, len(failed),
+                           error)
+
+    def send(self, pay_req):
+        """ Queue a payment, returns a Future resolved with the ln.SendResponse """
+        details = self.client.decode_pay_request(pay_req)
+        if details is None:
+            future = Future()
+            future.set_exception(ValueError(f'Can\'t decode payment request {pay_req}'))
+            return future
+        error = payment_error(details)
+        if error is not None:
+            future = Future()
+            future.set_exception(ValueError(error))
+            return future
+
+        with self._lock:
+            if details.payment_hash in self._futures:
+                return self._futures[details.payment_hash][1]
+
+            if self._requests is None:
+                self._open()
+            future = Future()
+            self._futures[details.payment_hash] = (StreamPayment(details, self._requests), future)
+            self._requests.put(self.client.send_request(details))
+        return future
+
+    def pay(self, pay_reqs, timeout=None):
+        """
+        :return: [PaymentResult] in input order
+        """
+        futures = [self.send(pay_req) for pay_req in pay_reqs]
+        results = []
+        for pay_req, future in zip(pay_reqs, futures):
+            try:
+                response = future.result(timeout=timeout)
+                payment_hash = response.payment_hash.hex()
+                if response.payment_error:
+                    results.append(PaymentResult(pay_req, payment_hash, None, response.payment_route, None,
+                                                 response.payment_error))
+                else:
+                    results.append(PaymentResult(pay_req, payment_hash, response.payment_preimage.hex(),
+                                                 response.payment_route, response.payment_route.total_fees_msat,
+                                                 None))
+            except Exception as e:
+                results.append(PaymentResult(pay_req, None, None, None, None, e))
+        return results
+
+    def close(self):
+        """ Half-close the stream, outstanding payments still complete """
+        with self._lock:
+            if self._requests is not None:
+                self._requests.put(self._closed)
+                self._requests = None
+        if self._reader is not None:
+            self._reader.join()
@@ -0,0 +1,164 @@
+import logging
+import threading
+import time
+
+from utils import backoff, lazy_import
+
+grpc = lazy_import('grpc')
+
+logger = logging.getLogger(__name__)
+
+# Seconds a unary call may take unless the caller passes its own timeout
+DEFAULT_TIMEOUT = 30
+DEFAULT_TIMEOUTS = {
+    'SendPaymentSync': 120,
+    'SendToRouteSync': 120,
+    'OpenChannelSync': 60,
+    'DescribeGraph': 120,
+    'ListInvoices': 60,
+    'QueryRoutes': 60,
+}
+
+# Calls without side effects, safe to send again when an attempt failed or timed out
+IDEMPOTENT = frozenset([
+    'WalletBalance', 'ChannelBalance', 'GetTransactions', 'ListUnspent', 'ListPeers', 'GetInfo', 'PendingChannels',
+    'ListChannels', 'ClosedChannels', 'ListInvoices', 'LookupInvoice', 'DecodePayReq', 'ListPayments',
+    'DescribeGraph', 'GetChanInfo', 'GetNodeInfo', 'GetNetworkInfo', 'QueryRoutes', 'FeeReport', 'VerifyMessage',
+])
+
+# Reads worth hedging, they are cheap for lnd and sit on the hot path
+HEDGED = frozenset(['GetInfo', 'ListChannels', 'PendingChannels', 'GetNodeInfo', 'GetChanInfo'])
+
+# grpc.StatusCode names
+RETRYABLE_CODES = frozenset(['UNAVAILABLE', 'DEADLINE_EXCEEDED'])
+
+
+class CallPolicy(object):
+    """ Deadlines, retries and hedging for unary lnd calls
+
+        Every unary call gets a deadline (`timeouts` per method, else `timeout`). Idempotent
+        calls failing with UNAVAILABLE or DEADLINE_EXCEEDED are retried up to `attempts` times
+        with jittered exponential backoff, within that same deadline. Calls that are not idempotent (payments, invoices,
+        channel opens) are never retried. With `hedge_delay` set, hedged reads send a second
+        copy of the request when the first has not answered within `hedge_delay` seconds and
+        return whichever answers first.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, timeouts=None, attempts=3, initial_backoff=0.1, max_backoff=2.0,
+                 hedge_delay=None, idempotent=IDEMPOTENT, hedged=HEDGED):
+        self.timeout = timeout
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.attempts = attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.hedge_delay = hedge_delay
+        self.idempotent = frozenset(idempotent)
+        self.hedged = frozenset(hedged)
+        self.retries = 0
+        self.hedges = 0
+        # calls run on many threads, the counters are updated under this lock
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """ CallPolicy from 'rpc_timeout', 'rpc_timeouts', 'rpc_attempts' and 'hedge_delay' node config """
+        return cls(timeout=config.get('rpc_timeout', DEFAULT_TIMEOUT), timeouts=config.get('rpc_timeouts'),
+                   attempts=config.get('rpc_attempts', 3), hedge_delay=config.get('hedge_delay'))
+
+    def timeout_for(self, method):
+        return self.timeouts.get(method, self.timeout)
+
+    def call(self, method, multicallable, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout_for(method)
+        hedge = self.hedge_delay is not None and method in self.hedged
+        attempts = self.attempts if method in self.idempotent else 1
+        delays = backoff(self.initial_backoff, self.max_backoff)
+        # the deadline covers every attempt and the backoff between them
+        deadline = time.monotonic() + timeout
+
+        for attempt in range(1, attempts + 1):
+            try:
+                if hedge:
+                    return self._hedged(multicallable, request, timeout, kwargs)
+                return multicallable(request, timeout=timeout, **kwargs)
+            except grpc.RpcError as e:
+                if attempt == attempts or e.code().name not in RETRYABLE_CODES:
+                    raise
+                delay = next(delays)
+                timeout = deadline - time.monotonic() - delay
+                if timeout <= 0:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                logger.debug('%s failed with %s, retry %d in %.2fs', method, e.code(), attempt, delay)
+                time.sleep(delay)
+
+    def _hedged(self, multicallable, request, timeout, kwargs):
+        first = multicallable.future(request, timeout=timeout, **kwargs)
+        try:
+            return first.result(timeout=self.hedge_delay)
+        except grpc.FutureTimeoutError:
+            pass
+
+        with self._lock:
+            self.hedges += 1
+        # the hedge gets what is left of the first call's deadline
+        second = multicallable.future(request, timeout=max(timeout - self.hedge_delay, 0.001), **kwargs)
+        calls = (first, second)
+        answered = threading.Event()
+        for call in calls:
+            call.add_done_callback(lambda f: answered.set())
+
+        while True:
+            answered.wait()
+            answered.clear()
+            for call in calls:
+                if call.done() and not call.cancelled() and call.exception() is None:
+                    for other in calls:
+                        if other is not call:
+                            other.cancel()
+                    return call.result()
+            if all(call.done() for call in calls):
+                return first.result()
+
+
+class PolicyMethod(object):
+    """ Unary stub method whose plain calls go through a CallPolicy """
+
+    def __init__(self, name, multicallable, policy):
+        self._name = name
+        self._multicallable = multicallable
+        self._policy = policy
+
+    def __call__(self, request, timeout=None, **kwargs):
+        return self._policy.call(self._name, self._multicallable, request, timeout=timeout, **kwargs)
+
+    def future(self, request, timeout=None, **kwargs):
+        # futures are used for fan-out where the caller handles errors, so only the deadline applies
+        if timeout is None:
+            timeout = self._policy.timeout_for(self._name)
+        return self._multicallable.future(request, timeout=timeout, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._multicallable, name)
+
+
+class PolicyStub(object):
+    """ Wraps a LightningStub so unary methods follow a CallPolicy, streaming methods are passed through
+
+            client = PolicyStub(lnrpc.LightningStub(channel), CallPolicy(hedge_delay=0.2))
+    """
+
+    def __init__(self, stub, policy):
+        self.stub = stub
+        self.policy = policy
+
+    def __getattr__(self, name):
+        multicallable = getattr(self.stub, name)
+        if isinstance(multicallable, grpc.UnaryUnaryMultiCallable):
+            method = PolicyMethod(name, multicallable, self.policy)
+            # cache the wrapper, __getattr__ is only consulted for missing attributes
+            setattr(self, name, method)
+            return method
+        return multicallable
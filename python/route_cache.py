@@ -0,0 +1,233 @@
+""" Routes to repeat destinations, so payouts skip lnd's pathfinding
+
+Routes come from QueryRoutes for the top of an amount bucket (powers of `bucket_base` satoshis),
+so they have the capacity for any amount in the bucket, and are stored with the fee policy of
+every channel. A hit reprices the routes for the exact amount and pays with SendToRouteSync.
+
+        cache = client.route_cache(updater=client.graph_updater())
+        cache.pay_invoice(pay_req)
+"""
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache
+from pathfind import DEFAULT_FINAL_CLTV_DELTA, RouteChannel, build_route
+from utils import lazy_import
+
+grpc = lazy_import('grpc')
+ln = lazy_import('rpc_pb2')
+
+logger = logging.getLogger(__name__)
+
+
+def amount_bucket(amt, base=2):
+    """ Smallest power of base >= amt """
+    bucket = 1
+    while bucket < amt:
+        bucket *= base
+    return bucket
+
+
+class RouteCache(object):
+    """ [RouteChannel] lists per (destination, amount bucket), from QueryRoutes
+
+        Entries are dropped after `ttl` seconds, when a graph update touches one of their channels
+        (pass on_graph_update as a GraphUpdater listener), and when paying over them fails.
+        pay() falls back to SendPaymentSync on a miss or failure and refreshes the entry in the
+        background, so the next payment to that destination hits.
+    """
+
+    def __init__(self, client, num_routes=3, bucket_base=2, ttl=600, maxsize=10000, graph=None, workers=4):
+        """
+        :type client: lnd.RpcClient
+        :param graph: graph.ChannelGraph to read channel policies from, GetChanInfo is used for the rest
+        """
+        self.client = client
+        self.num_routes = num_routes
+        self.bucket_base = bucket_base
+        self.graph = graph
+        self.entries = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._height = LRUCache(maxsize=1, ttl=10)
+        self._lock = threading.Lock()
+        # chan_id -> keys of the entries routing over it, rebuilt from the live entries every `maxsize` stores
+        # so entries the LRU evicted or that expired don't pile up
+        self._keys = defaultdict(set)
+        self._stores = 0
+        self._refreshing = set()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'route-cache-{client}')
+        self.invalidations = 0
+
+    def key(self, destination, amt):
+        return destination, amount_bucket(amt, self.bucket_base)
+
+    def block_height(self):
+        height = self._height.get(None)
+        if height is None:
+            height = self.client.client.GetInfo(ln.GetInfoRequest()).block_height
+            self._height.set(None, height)
+        return height
+
+    def _policies(self, routes):
+        """ {(chan_id, paying node): (fee_base_msat, fee_rate_ppm, cltv_delta)} of the channels charging a fee """
+        wanted = {(hop.chan_id, payer.pub_key) for route in routes for payer, hop in zip(route.hops, route.hops[1:])}
+        policies = {}
+        if self.graph is not None:
+            with self.graph.lock:
+                for chan_id, payer in wanted:
+                    edge = self.graph.edge_id(chan_id, payer)
+                    if edge is not None and self.graph.usable(edge):
+                        policies[chan_id, payer] = (self.graph.fee_base_msat[edge], self.graph.fee_rate_ppm[edge],
+                                                    self.graph.cltv_delta[edge])
+
+        missing = {chan_id for chan_id, payer in wanted if (chan_id, payer) not in policies}
+        futures = {chan_id: self.client.client.GetChanInfo.future(ln.ChanInfoRequest(chan_id=chan_id))
+                   for chan_id in missing}
+        for chan_id, future in futures.items():
+            try:
+                edge = future.result()
+            except grpc.RpcError as e:
+                logger.debug('%s: no policy for channel %s: %s', self.client, chan_id, e.details())
+                continue
+            for payer, field in ((edge.node1_pub, 'node1_policy'), (edge.node2_pub, 'node2_policy')):
+                if (chan_id, payer) in wanted and edge.HasField(field):
+                    policy = getattr(edge, field)
+                    policies[chan_id, payer] = (policy.fee_base_msat, policy.fee_rate_milli_msat,
+                                                policy.time_lock_delta)
+        return policies
+
+    def fetch(self, destination, amt, final_cltv_delta=DEFAULT_FINAL_CLTV_DELTA):
+        """ QueryRoutes for the bucket of amt and store the result, [[RouteChannel]]
+
+        Routes over a channel whose policy is unknown are left out, they couldn't be repriced.
+        """
+        key = self.key(destination, amt)
+        response = self.client.client.QueryRoutes(ln.QueryRoutesRequest(
+            pub_key=destination, amt=key[1], num_routes=self.num_routes, final_cltv_delta=final_cltv_delta))
+        policies = self._policies(response.routes)
+
+        entry = []
+        for route in response.routes:
+            # our own first channel charges no fee
+            first = route.hops[0]
+            channels = [RouteChannel(first.chan_id, first.chan_capacity, first.pub_key, 0, 0, 0)]
+            for payer, hop in zip(route.hops, route.hops[1:]):
+                policy = policies.get((hop.chan_id, payer.pub_key))
+                if policy is None:
+                    break
+                channels.append(RouteChannel(hop.chan_id, hop.chan_capacity, hop.pub_key, *policy))
+            if len(channels) == len(route.hops):
+                entry.append(channels)
+
+        if entry:
+            self.entries.set(key, entry)
+            with self._lock:
+                self._stores += 1
+                if self._stores >= self.entries.maxsize:
+                    self._prune()
+                for channels in entry:
+                    for channel in channels:
+                        self._keys[channel.chan_id].add(key)
+        return entry
+
+    def _prune(self):
+        """ Rebuild _keys from the live entries, holding _lock """
+        keys = defaultdict(set)
+        for key, entry in self.entries.items():
+            for channels in entry:
+                for channel in channels:
+                    keys[channel.chan_id].add(key)
+        self._keys = keys
+        self._stores = 0
+
+    def routes(self, destination, amt, final_cltv_delta=DEFAULT_FINAL_CLTV_DELTA, fetch=True):
+        """ [ln.Route] paying exactly amt satoshis to destination, [] on a miss when fetch is False """
+        entry = self.entries.get(self.key(destination, amt))
+        if entry is None:
+            if not fetch:
+                return []
+            entry = self.fetch(destination, amt, final_cltv_delta)
+        height = self.block_height()
+        return [build_route(channels, amt * 1000, height, final_cltv_delta) for channels in entry]
+
+    def invalidate(self, destination, amt):
+        if self.entries.pop(self.key(destination, amt)) is not None:
+            self.invalidations += 1
+
+    def invalidate_channels(self, chan_ids):
+        """ Drop every entry routing over one of chan_ids """
+        with self._lock:
+            keys = set()
+            for chan_id in chan_ids:
+                keys |= self._keys.pop(chan_id, set())
+        for key in keys:
+            if self.entries.pop(key) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self.entries.clear()
+        with self._lock:
+            self._keys.clear()
+            self._stores = 0
+
+    def on_graph_update(self, update):
+        """ GraphUpdater listener: policy changes and closes invalidate the entries using the channel """
+        self.invalidate_channels([channel.chan_id for channel in update.channel_updates]
+                                 + [channel.chan_id for channel in update.closed_chans])
+
+    def refresh(self, destination, amt, final_cltv_delta=DEFAULT_FINAL_CLTV_DELTA):
+        """ fetch() in the background, at most once at a time per key """
+        key = self.key(destination, amt)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self.fetch(destination, amt, final_cltv_delta)
+            except Exception as e:
+                logger.debug('%s: no routes to %s for %s sat: %r', self.client, destination, key[1], e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._pool.submit(run)
+
+    def pay(self, invoice_details):
+        """ Pay a decoded ln.PayReq over cached routes, with SendPaymentSync on a miss or failure
+
+        :return: ln.SendResponse
+        """
+        destination, amt = invoice_details.destination, invoice_details.num_satoshis
+        final_cltv_delta = invoice_details.cltv_expiry or DEFAULT_FINAL_CLTV_DELTA
+        routes = self.routes(destination, amt, final_cltv_delta, fetch=False)
+        if routes:
+            try:
+                response = self.client.client.SendToRouteSync(ln.SendToRouteRequest(
+                    payment_hash_string=invoice_details.payment_hash, routes=routes))
+                error = response.payment_error
+            except grpc.RpcError as e:
+                error = e
+            if not error:
+                return response
+            logger.debug('%s: cached routes to %s failed: %s', self.client, destination, error)
+            self.invalidate(destination, amt)
+
+        response = self.client.client.SendPaymentSync(self.client.send_request(invoice_details))
+        self.refresh(destination, amt, final_cltv_delta)
+        return response
+
+    def pay_invoice(self, pay_req):
+        invoice_details = self.client.decode_pay_request(pay_req)
+        try:
+            return self.pay(invoice_details)
+        except Exception as e:
+            logger.exception(e)
+
+    def stats(self):
+        return dict(self.entries.stats(), invalidations=self.invalidations)
+
+    def close(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,141 @@
+import logging
+import queue
+import threading
+
+from utils import backoff, lazy_import
+
+grpc = lazy_import('grpc')
+ln = lazy_import('rpc_pb2')
+
+logger = logging.getLogger(__name__)
+# one record per update, see utils.configure_logging(sample_every=...)
+events = logging.getLogger(f'{__name__}.events')
+
+
+class InvoiceSubscriber(object):
+    """ Long running SubscribeInvoices consumer
+
+        Updates are read on a dedicated thread into a bounded queue. When the queue is full
+        the reader blocks, so lnd is throttled by HTTP/2 flow control instead of us buffering
+        without limit. With a callback a second thread drains the queue, otherwise consume
+        with get() or by iterating the subscriber.
+
+        Broken streams are reopened with jittered exponential backoff, resuming from the
+        highest add_index/settle_index seen. lnd replays nothing for an index of 0, so indexes
+        left at 0 are first seeded from the newest seed_invoices invoices (ListInvoices reversed).
+        Settlements of older invoices that are above the seeded settle_index are replayed once.
+        If none of those invoices is settled settle_index stays 0, and settlements made while the
+        stream is down are lost until the first settlement has been received.
+        Persist add_index/settle_index to resume across restarts.
+
+            subscriber = InvoiceSubscriber(client, callback=settle).start()
+            ...
+            subscriber.stop()
+    """
+
+    def __init__(self, client, callback=None, add_index=0, settle_index=0, max_queue=10000,
+                 initial_backoff=0.5, max_backoff=30.0, seed_invoices=100):
+        """
+        :type client: lnd.RpcClient
+        :param callback: called with every ln.Invoice update, on the dispatcher thread
+        """
+        self.client = client
+        self.callback = callback
+        self.add_index = add_index
+        self.settle_index = settle_index
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.seed_invoices = seed_invoices
+        self.reconnects = 0
+        self.received = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stopped = threading.Event()
+        self._call = None
+        self._threads = []
+
+    def __iter__(self):
+        while not self._stopped.is_set() or not self._queue.empty():
+            try:
+                yield self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    def start(self):
+        self._threads.append(threading.Thread(target=self._read, name=f'invoices-{self.client}', daemon=True))
+        if self.callback is not None:
+            self._threads.append(threading.Thread(target=self._dispatch, name=f'invoices-cb-{self.client}',
+                                                  daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._call is not None:
+            self._call.cancel()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def get(self, timeout=None):
+        """ Next ln.Invoice update, raises queue.Empty on timeout """
+        return self._queue.get(timeout=timeout)
+
+    def _put(self, invoice):
+        # block while full (backpressure), but wake up to notice stop()
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(invoice, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _seed(self):
+        """ Raise indexes still at 0 to the highest ones among the newest invoices """
+        request = ln.ListInvoiceRequest(num_max_invoices=self.seed_invoices, reversed=True)
+        invoices = self.client.client.ListInvoices(request).invoices
+        if not self.add_index:
+            self.add_index = max((invoice.add_index for invoice in invoices), default=0)
+        if not self.settle_index:
+            self.settle_index = max((invoice.settle_index for invoice in invoices), default=0)
+        logger.debug('%s: seeded invoice subscription at add_index %d, settle_index %d', self.client,
+                     self.add_index, self.settle_index)
+
+    def _read(self):
+        delays = backoff(self.initial_backoff, self.max_backoff)
+        seeded = not self.seed_invoices
+        while not self._stopped.is_set():
+            try:
+                if not seeded and (not self.add_index or not self.settle_index):
+                    self._seed()
+                seeded = True
+                request = ln.InvoiceSubscription(add_index=self.add_index, settle_index=self.settle_index)
+                # wait_for_ready: while the channel reconnects the call waits instead of failing fast
+                self._call = self.client.client.SubscribeInvoices(request, wait_for_ready=True)
+                for invoice in self._call:
+                    self.add_index = max(self.add_index, invoice.add_index)
+                    self.settle_index = max(self.settle_index, invoice.settle_index)
+                    self.received += 1
+                    events.debug('%s: invoice add_index %d settle_index %d state %s', self.client, invoice.add_index,
+                                 invoice.settle_index, invoice.state)
+                    self._put(invoice)
+                    delays = backoff(self.initial_backoff, self.max_backoff)
+            except grpc.RpcError as e:
+                if self._stopped.is_set():
+                    return
+                logger.warning('%s: invoice subscription broke (%s: %s)', self.client, e.code(), e.details())
+            except Exception as e:
+                logger.exception(e)
+
+            if self._stopped.wait(next(delays)):
+                return
+            self.reconnects += 1
+            logger.info('%s: resubscribing to invoices after add_index %d, settle_index %d', self.client,
+                        self.add_index, self.settle_index)
+
+    def _dispatch(self):
+        for invoice in self:
+            try:
+                self.callback(invoice)
+            except Exception as e:
+                logger.exception(e)
@@ -0,0 +1,108 @@
+import hashlib
+from unittest import TestCase
+
+import bolt11
+import rpc_pb2 as ln
+
+# BOLT11 specification test vectors, not recorded lnd output; expected fields are what lnd's DecodePayReq reports
+# for them
+NODE_ID = '03e7156ae33b0a208d0744199163177e909e80176e55d97a2f221ede0f934dd9ad'
+PAYMENT_HASH = '0001020304050607080900010203040506070809000102030405060708090102'
+DESCRIPTION_HASH = '3925b6f67e2c340036ed12093dd44e0368df1b6ea26c53dbe4811f58fd5db8c1'
+
+FIXTURES = [
+    ('lnbc1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdpl2pkx2ctnv5sxxmmwwd5kgetjypeh2ursdae8g6twv'
+     'us8g6rfwvs8qun0dfjkxaq8rkx3yf5tcsyz3d73gafnh3cax9rn449d9p5uxz9ezhhypd0elx87sjle52x86fux2ypatgddc6k63n7erqz25le4'
+     '2c4u4ecky03ylcqca784w',
+     ln.PayReq(destination=NODE_ID, payment_hash=PAYMENT_HASH, timestamp=1496314658, expiry=3600, cltv_expiry=9,
+               description='Please consider supporting this project')),
+    ('lnbc2500u1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdq5xysxxatsyp3k7enxv4jsxqzpuaztrnwngzn3k'
+     'dzw5hydlzf03qdgm2hdq27cqv3agm2awhz5se903vruatfhq77w3ls4evs3ch9zw97j25emudupq63nyw24cg27h2rspfj9srp',
+     ln.PayReq(destination=NODE_ID, payment_hash=PAYMENT_HASH, num_satoshis=250000, timestamp=1496314658, expiry=60,
+               cltv_expiry=9, description='1 cup coffee')),
+    ('lnbc2500u1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdpquwpc4curk03c9wlrswe78q4eyqc7d8d0xqzpuy'
+     'k0sg5g70me25alkluzd2x62aysf2pyy8edtjeevuv4p2d5p76r4zkmneet7uvyakky2zr4cusd45tftc9c5fh0nnqpnl2jfll544esqchsrny',
+     ln.PayReq(destination=NODE_ID, payment_hash=PAYMENT_HASH, num_satoshis=250000, timestamp=1496314658, expiry=60,
+               cltv_expiry=9, description='ナンセンス 1杯')),
+    ('lntb20m1pvjluezhp58yjmdan79s6qqdhdzgynm4zwqd5d7xmw5fk98klysy043l2ahrqspp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcy'
+     'q5rqwzqfqypqfpp3x9et2e20v6pu37c5d9vax37wxq72un98kmzzhznpurw9sgl2v0nklu2g4d0keph5t7tj9tcqd8rexnd07ux4uv2cjvcqwax'
+     'gj7v4uwn5wmypjd5n69z2xm3xgksg28nwht7f6zspwp3f9t',
+     ln.PayReq(destination=NODE_ID, payment_hash=PAYMENT_HASH, num_satoshis=2000000, timestamp=1496314658, expiry=3600,
+               cltv_expiry=9, description_hash=DESCRIPTION_HASH, fallback_addr='mk2QpYatsKicvFVuTAQLBryyccRXMUaGHP')),
+    ('lnbc20m1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqhp58yjmdan79s6qqdhdzgynm4zwqd5d7xmw5fk98kl'
+     'ysy043l2ahrqsfpp3qjmp7lwpagxun9pygexvgpjdc4jdj85fr9yq20q82gphp2nflc7jtzrcazrra7wwgzxqc8u7754cdlpfrmccae92qgzqvzq'
+     '2ps8pqqqqqqpqqqqq9qqqvpeuqafqxu92d8lr6fvg0r5gv0heeeqgcrqlnm6jhphu9y00rrhy4grqszsvpcgpy9qqqqqqgqqqqq7qqzqj9n4evl'
+     '6mr5aj9f58zp6fyjzup6ywn3x6sk8akg5v4tgn2q8g4fhx05wf6juaxu9760yp46454gpg5mtzgerlzezqcqvjnhjh8z3g2qqdhhwkj',
+     ln.PayReq(destination=NODE_ID, payment_hash=PAYMENT_HASH, num_satoshis=2000000, timestamp=1496314658, expiry=3600,
+               cltv_expiry=9, description_hash=DESCRIPTION_HASH, fallback_addr='1RustyRX2oai4EYYDpQGWvEL62BBGqN9T',
+               route_hints=[ln.RouteHint(hop_hints=[
+                   ln.HopHint(node_id='029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255',
+                              chan_id=72623859790382856, fee_base_msat=1, fee_proportional_millionths=20,
+                              cltv_expiry_delta=3),
+                   ln.HopHint(node_id='039e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255',
+                              chan_id=217304205466536202, fee_base_msat=2, fee_proportional_millionths=30,
+                              cltv_expiry_delta=4),
+               ])])),
+]
+
+# the node key of the specification's examples
+PRIVATE_KEY = 0xe126f68f7eafcc8b74f54d269fe206be715000f94dac067d1c04a8ca3b2db734
+
+
+def with_node_id(pay_req, node_id, private_key=PRIVATE_KEY):
+    """ pay_req with an `n` field added, signed again with private_key """
+    hrp, data = bolt11.bech32_decode(pay_req)
+    field = bolt11.convertbits(bytes.fromhex(node_id), 8, 5)
+    signed = data[:bolt11.TIMESTAMP_GROUPS] + [bolt11.TAG_NODE_ID, 1, len(field) - 32] + field + \
+        data[bolt11.TIMESTAMP_GROUPS:-bolt11.SIGNATURE_GROUPS]
+    msg_hash = hashlib.sha256(hrp.encode() + bytes(bolt11.convertbits(signed, 5, 8))).digest()
+    k = int.from_bytes(hashlib.sha256(msg_hash + private_key.to_bytes(32, 'big')).digest(), 'big') % bolt11.N
+    x, y = bolt11._affine(bolt11._double_multiply(k, bolt11.G, 0, bolt11.G))
+    r = x % bolt11.N
+    s = pow(k, -1, bolt11.N) * (int.from_bytes(msg_hash, 'big') + r * private_key) % bolt11.N
+    signature = r.to_bytes(32, 'big') + s.to_bytes(32, 'big') + bytes([y & 1])
+    return bolt11.bech32_encode(hrp, signed + bolt11.convertbits(signature, 8, 5))
+
+
+class TestBolt11(TestCase):
+
+    def test_decode(self):
+        for pay_req, expected in FIXTURES:
+            self.assertEqual(expected, bolt11.decode(pay_req), pay_req)
+
+    def test_decode_upper_case(self):
+        pay_req, expected = FIXTURES[0]
+        self.assertEqual(expected, bolt11.decode(pay_req.upper()))
+
+    def test_decode_many(self):
+        pay_reqs = [pay_req for pay_req, expected in FIXTURES]
+        decoded = bolt11.decode_many(pay_reqs + [pay_reqs[0][:-1] + 'q'])
+        self.assertEqual([expected for pay_req, expected in FIXTURES], decoded[:-1])
+        self.assertIsInstance(decoded[-1], ValueError)
+
+    def test_invalid(self):
+        pay_req = FIXTURES[0][0]
+        for invalid in (pay_req[:-1] + 'q', 'lnbc1' + pay_req[5:].upper(), 'xxbc' + pay_req[4:], pay_req[:20]):
+            with self.assertRaises(ValueError):
+                bolt11.decode(invalid)
+
+    def test_amounts(self):
+        self.assertEqual(('bc', None), bolt11.parse_hrp('lnbc'))
+        self.assertEqual(('bcrt', 250000000), bolt11.parse_hrp('lnbcrt2500u'))
+        self.assertEqual(('tb', 1), bolt11.parse_hrp('lntb10p'))
+        with self.assertRaises(ValueError):
+            bolt11.parse_hrp('lnbc1p')
+
+    def test_node_id_field(self):
+        pay_req, expected = FIXTURES[1]
+        pay_req = with_node_id(pay_req, NODE_ID)
+        for verify in (None, False, True):
+            self.assertEqual(expected, bolt11.decode(pay_req, verify=verify))
+
+        # signed by the spec's node, claiming to be another one
+        other = bolt11._affine(bolt11._double_multiply(2, bolt11.G, 0, bolt11.G))
+        other_id = (bytes([2 + (other[1] & 1)]) + other[0].to_bytes(32, 'big')).hex()
+        forged = with_node_id(FIXTURES[1][0], other_id)
+        with self.assertRaisesRegex(ValueError, 'signature'):
+            bolt11.decode(forged, verify=True)
+        self.assertEqual(other_id, bolt11.decode(forged, verify=False).destination)
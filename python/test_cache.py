@@ -0,0 +1,80 @@
+from unittest import TestCase
+
+from cache import LRUCache
+
+
+class Clock(object):
+    """ Monotonic clock the test moves forward """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=10, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=20)
+        cache.set('c', 3, ttl=None)
+
+        self.clock.now += 9.9
+        self.assertEqual(1, cache.get('a'))
+        # expired entries are dropped on access
+        self.clock.now += 0.1
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual('gone', cache.get('a', 'gone'))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(2, cache.get('b'))
+
+        self.clock.now += 1000
+        self.assertNotIn('b', cache)
+        self.assertEqual(3, cache.get('c'))
+
+    def test_eviction_order(self):
+        cache = LRUCache(maxsize=3, clock=self.clock)
+        for key in 'abc':
+            cache.set(key, key)
+        # reading or setting an entry makes it the most recently used
+        cache.get('a')
+        cache.set('b', 'B')
+        cache.set('d', 'd')
+        self.assertEqual([('a', 'a'), ('b', 'B'), ('d', 'd')], cache.items())
+        cache.set('e', 'e')
+        self.assertEqual(['b', 'd', 'e'], [key for key, value in cache.items()])
+
+    def test_items_drop_expired(self):
+        cache = LRUCache(ttl=10, clock=self.clock)
+        cache.set('a', 1)
+        self.clock.now += 5
+        cache.set('b', 2)
+        self.clock.now += 5
+        self.assertEqual([('b', 2)], cache.items())
+        self.assertEqual(1, len(cache))
+
+    def test_counters(self):
+        cache = LRUCache(ttl=10, clock=self.clock)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        # membership tests don't count
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.clock.now += 10
+        cache.get('a')
+        self.assertEqual({'size': 0, 'hits': 1, 'misses': 2}, cache.stats())
+
+    def test_pop_and_clear(self):
+        cache = LRUCache(clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.pop('a'))
+        self.assertEqual('none', cache.pop('a', 'none'))
+        cache.clear()
+        self.assertEqual(0, len(cache))
@@ -0,0 +1,141 @@
+from unittest import TestCase
+
+import rpc_pb2 as ln
+from channels import BatchOpener, ChannelIndex, CloseManager, channel_point_str
+
+PENDING_TXID = bytes(range(32))
+CLOSING_TXID = bytes(range(32, 64))
+POINT_A = 'aa' * 32 + ':0'
+POINT_B = 'bb' * 32 + ':1'
+PEER = '02' + 'cc' * 32
+
+
+def pending():
+    return ln.CloseStatusUpdate(close_pending=ln.PendingUpdate(txid=PENDING_TXID))
+
+
+def closed():
+    return ln.CloseStatusUpdate(chan_close=ln.ChannelCloseUpdate(closing_txid=CLOSING_TXID, success=True))
+
+
+def opened():
+    return [ln.OpenStatusUpdate(chan_pending=ln.PendingUpdate(txid=PENDING_TXID)),
+            ln.OpenStatusUpdate(chan_open=ln.ChannelOpenUpdate(channel_point=ln.ChannelPoint(
+                funding_txid_bytes=PENDING_TXID)))]
+
+
+class FakeCall(object):
+    """ Response stream of a streaming call """
+
+    def __init__(self, updates):
+        self._updates = iter(updates)
+        self.cancelled = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._updates)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeStub(object):
+    """ CloseChannel returns the next list of updates queued for the channel point """
+
+    def __init__(self, updates):
+        self.updates = updates
+        self.requests = []
+        self.calls = []
+
+    def CloseChannel(self, request):
+        self.requests.append(request)
+        updates = self.updates[channel_point_str(request.channel_point)].pop(0)
+        if isinstance(updates, Exception):
+            raise updates
+        self.calls.append(FakeCall(updates))
+        return self.calls[-1]
+
+    def OpenChannel(self, request):
+        self.requests.append(request)
+        self.calls.append(FakeCall(opened()))
+        return self.calls[-1]
+
+
+class FakeClient(object):
+
+    def __init__(self, updates):
+        self.client = FakeStub(updates)
+        self.channels = ChannelIndex(self)
+        self.channels.by_channel_point = {POINT_A: ln.Channel(channel_point=POINT_A, chan_id=1)}
+
+    def __str__(self):
+        return 'fake'
+
+    def channel_exists_with_node(self, pubkey):
+        return False
+
+
+class TestCloseManager(TestCase):
+
+    def test_pending_and_closed(self):
+        client = FakeClient({POINT_A: [[pending(), closed()]]})
+        manager = CloseManager(client)
+        futures = manager.close([POINT_A], target_conf=6)
+
+        self.assertEqual(CLOSING_TXID[::-1].hex(), futures[POINT_A].result(timeout=5))
+        self.assertEqual(PENDING_TXID[::-1].hex(), manager.pending_txids[POINT_A])
+        self.assertEqual(6, client.client.requests[0].target_conf)
+        self.assertTrue(client.client.calls[0].cancelled)
+        # the channel index forgets the channel as soon as the close starts
+        self.assertNotIn(POINT_A, client.channels.by_channel_point)
+        # a close in progress or done is not started again
+        self.assertIs(futures[POINT_A], manager.close([POINT_A])[POINT_A])
+        self.assertEqual(1, len(client.client.requests))
+
+    def test_errors(self):
+        client = FakeClient({POINT_A: [[pending()], [pending(), closed()]],
+                             POINT_B: [RuntimeError('channel not found')]})
+        manager = CloseManager(client)
+        futures = manager.close([POINT_A, POINT_B])
+
+        # the stream ended without chan_close
+        with self.assertRaises(RuntimeError):
+            futures[POINT_A].result(timeout=5)
+        with self.assertRaisesRegex(RuntimeError, 'channel not found'):
+            futures[POINT_B].result(timeout=5)
+        # failed closes are retried
+        self.assertEqual(CLOSING_TXID[::-1].hex(), manager.close([POINT_A])[POINT_A].result(timeout=5))
+
+    def test_workers(self):
+        points = [f'{i:064x}:0' for i in range(10)]
+        client = FakeClient({point: [[pending(), closed()]] for point in points})
+        manager = CloseManager(client, workers=2)
+        futures = manager.close(points)
+
+        self.assertEqual([CLOSING_TXID[::-1].hex()] * 10, [futures[point].result(timeout=5) for point in points])
+        self.assertEqual(10, len(client.client.requests))
+        self.assertLessEqual(len(manager._threads), 2)
+
+        with self.assertRaises(ValueError):
+            CloseManager(client, workers=0)
+
+
+class TestBatchOpener(TestCase):
+
+    def test_one_channel_per_peer_and_batch(self):
+        client = FakeClient({})
+        openings = BatchOpener(client, max_pending_per_peer=2).open(
+            [{'node_pubkey_string': PEER, 'local_funding_amount': 100000}] * 2)
+
+        self.assertEqual(channel_point_str(ln.ChannelPoint(funding_txid_bytes=PENDING_TXID)),
+                         openings[0].pending.result(timeout=5))
+        with self.assertRaisesRegex(AssertionError, 'Channel already opened'):
+            openings[1].open.result(timeout=5)
+        self.assertEqual(1, len(client.client.requests))
+
+        # unless forced
+        forced = BatchOpener(client, max_pending_per_peer=2).open(
+            [{'node_pubkey_string': PEER, 'local_funding_amount': 100000, 'force': True}] * 2)
+        self.assertEqual(2, len([opening.open.result(timeout=5) for opening in forced]))
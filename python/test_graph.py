@@ -0,0 +1,167 @@
+from unittest import TestCase
+
+import rpc_pb2 as ln
+from graph import CLOSED, DISABLED, NO_POLICY, ChannelGraph, GraphUpdater
+
+ALICE = '02' + 'aa' * 32
+BOB = '03' + 'bb' * 32
+CAROL = '02' + 'cc' * 32
+
+
+def policy(fee_base_msat=1000, fee_rate_milli_msat=1, time_lock_delta=40, disabled=False):
+    return ln.RoutingPolicy(time_lock_delta=time_lock_delta, min_htlc=1000, fee_base_msat=fee_base_msat,
+                            fee_rate_milli_msat=fee_rate_milli_msat, disabled=disabled)
+
+
+# alice <-> bob <-> carol, bob -> carol disabled, carol never announced a policy for channel 2
+DESCRIBE_GRAPH = ln.ChannelGraph(
+    nodes=[ln.LightningNode(pub_key=ALICE, alias='alice'), ln.LightningNode(pub_key=BOB, alias='bob'),
+           ln.LightningNode(pub_key=CAROL, alias='carol')],
+    edges=[ln.ChannelEdge(channel_id=1, node1_pub=ALICE, node2_pub=BOB, capacity=1000000,
+                          node1_policy=policy(), node2_policy=policy(fee_rate_milli_msat=100)),
+           ln.ChannelEdge(channel_id=2, node1_pub=BOB, node2_pub=CAROL, capacity=500000,
+                          node1_policy=policy(disabled=True))])
+
+
+class TestChannelGraph(TestCase):
+
+    def setUp(self):
+        self.graph = ChannelGraph.from_describe_graph(DESCRIBE_GRAPH)
+
+    def test_load(self):
+        self.assertEqual(3, self.graph.num_nodes)
+        self.assertEqual(2, len(self.graph))
+        self.assertEqual(4, self.graph.num_edges)
+        self.assertEqual('bob', self.graph.alias(BOB))
+
+        edge = self.graph.edge(self.graph.edge_id(1, BOB))
+        self.assertEqual((BOB, ALICE, 1000000, 100, 0), (edge.source, edge.target, edge.capacity, edge.fee_rate_ppm,
+                                                         edge.flags))
+        self.assertEqual(DISABLED, self.graph.edge(self.graph.edge_id(2, BOB)).flags)
+        self.assertEqual(NO_POLICY, self.graph.edge(self.graph.edge_id(2, CAROL)).flags)
+
+    def test_adjacency(self):
+        bob = self.graph.node_ids[BOB]
+        self.assertEqual({ALICE, CAROL}, {self.graph.edge(e).target for e in self.graph.out_edges(bob)})
+        self.assertEqual({ALICE, CAROL}, {self.graph.edge(e).source for e in self.graph.in_edges(bob)})
+
+        # new channels invalidate the CSR indexes
+        self.graph.add_channel(3, CAROL, ALICE, 200000)
+        carol = self.graph.node_ids[CAROL]
+        self.assertEqual({BOB, ALICE}, {self.graph.edge(e).target for e in self.graph.out_edges(carol)})
+
+    def test_updates(self):
+        edge = self.graph.set_policy(2, BOB, policy(fee_base_msat=0))
+        self.assertTrue(self.graph.usable(edge))
+        self.assertIsNone(self.graph.set_policy(42, BOB, policy()))
+
+        self.assertTrue(self.graph.close_channel(2))
+        self.assertEqual(CLOSED, self.graph.flags[edge])
+        self.assertFalse(self.graph.close_channel(42))
+
+        self.graph.load(DESCRIBE_GRAPH)
+        self.assertEqual(DISABLED, self.graph.flags[self.graph.edge_id(2, BOB)])
+        self.assertGreater(self.graph.nbytes(), 0)
+
+    def test_node_info(self):
+        info = self.graph.node_info(BOB)
+        self.assertEqual(('bob', 2, 1500000), (info.node.alias, info.num_channels, info.total_capacity))
+        self.graph.close_channel(1)
+        self.assertEqual(1, self.graph.node_info(BOB).num_channels)
+        self.assertIsNone(self.graph.node_info('02' + 'dd' * 32))
+
+
+class TestGraphUpdater(TestCase):
+
+    def test_apply(self):
+        graph = ChannelGraph.from_describe_graph(DESCRIBE_GRAPH)
+        updater = GraphUpdater(None, graph=graph)
+        updates = []
+        updater.add_listener(updates.append)
+
+        update = ln.GraphTopologyUpdate(
+            node_updates=[ln.NodeUpdate(identity_key=ALICE, alias='alice2')],
+            channel_updates=[ln.ChannelEdgeUpdate(chan_id=2, capacity=500000, advertising_node=CAROL,
+                                                  connecting_node=BOB, routing_policy=policy(fee_base_msat=5)),
+                             ln.ChannelEdgeUpdate(chan_id=3, capacity=300000, advertising_node=CAROL,
+                                                  connecting_node=ALICE, routing_policy=policy())],
+            closed_chans=[ln.ClosedChannelUpdate(chan_id=1)])
+        updater.apply(update)
+
+        self.assertEqual([update], updates)
+        self.assertEqual('alice2', graph.alias(ALICE))
+        self.assertEqual(5, graph.edge(graph.edge_id(2, CAROL)).fee_base_msat)
+        self.assertEqual(0, graph.edge(graph.edge_id(2, CAROL)).flags)
+        # a new channel, only the advertised direction has a policy
+        self.assertEqual(3, len(graph))
+        self.assertEqual(0, graph.edge(graph.edge_id(3, CAROL)).flags)
+        self.assertEqual(NO_POLICY, graph.edge(graph.edge_id(3, ALICE)).flags)
+        self.assertEqual(CLOSED, graph.edge(graph.edge_id(1, ALICE)).flags)
+
+    def test_reconcile(self):
+        graph = ChannelGraph.from_describe_graph(DESCRIBE_GRAPH)
+        # carol announced her side of channel 2, and channel 1 is gone
+        snapshot = ln.ChannelGraph(nodes=DESCRIBE_GRAPH.nodes, edges=[ln.ChannelEdge(
+            channel_id=2, node1_pub=BOB, node2_pub=CAROL, capacity=500000, node1_policy=policy(disabled=True),
+            node2_policy=policy(fee_base_msat=9))])
+        # alice renames herself while the snapshot downloads
+        during = ln.GraphTopologyUpdate(node_updates=[ln.NodeUpdate(identity_key=ALICE, alias='alice2')])
+
+        class Stub(object):
+            def DescribeGraph(stub, request):
+                updater.apply(during)
+                return snapshot
+
+        class Client(object):
+            client = Stub()
+
+        updater = GraphUpdater(Client(), graph=graph)
+        updates = []
+        updater.add_listener(updates.append)
+        updater.reconcile()
+
+        self.assertEqual('alice2', graph.alias(ALICE))
+        self.assertEqual(9, graph.edge(graph.edge_id(2, CAROL)).fee_base_msat)
+        # the update replayed on the snapshot is not passed on twice, the reconcile reports what changed
+        self.assertEqual(2, len(updates))
+        self.assertIs(during, updates[0])
+        self.assertEqual([1], [closed.chan_id for closed in updates[1].closed_chans])
+        self.assertEqual([(2, CAROL, 9)], [(channel.chan_id, channel.advertising_node,
+                                            channel.routing_policy.fee_base_msat)
+                                           for channel in updates[1].channel_updates])
+
+        # the same snapshot again: only the update received meanwhile is passed on
+        updater.reconcile()
+        self.assertEqual([during], updates[2:])
+
+    def test_start_on_empty_graph_notifies_nothing(self):
+        # the stream is already running while the first snapshot downloads
+        during = ln.GraphTopologyUpdate(channel_updates=[ln.ChannelEdgeUpdate(
+            chan_id=2, capacity=500000, advertising_node=CAROL, connecting_node=BOB,
+            routing_policy=policy(fee_base_msat=9))])
+
+        class Stub(object):
+            def DescribeGraph(stub, request):
+                updater.apply(during)
+                return DESCRIBE_GRAPH
+
+            def SubscribeChannelGraph(stub, request, wait_for_ready=None):
+                return Call()
+
+        class Call(list):
+            def cancel(call):
+                pass
+
+        class Client(object):
+            client = Stub()
+
+        updater = GraphUpdater(Client(), initial_backoff=60)
+        updates = []
+        updater.add_listener(updates.append)
+        updater.start()
+        updater.stop()
+
+        self.assertEqual(2, len(updater.graph))
+        self.assertEqual(9, updater.graph.edge(updater.graph.edge_id(2, CAROL)).fee_base_msat)
+        # only the update itself, not every channel of the snapshot
+        self.assertEqual([during], updates)
@@ -0,0 +1,42 @@
+import time
+from unittest import TestCase
+
+import rpc_pb2 as ln
+from invoice_store import InvoiceStore
+
+
+class FakeClient(object):
+    """ iter_invoices records where each catch up started """
+
+    def __init__(self):
+        self.start_indexes = []
+
+    def iter_invoices(self, page_size=1000, start_index=0):
+        self.start_indexes.append(start_index)
+        return iter([])
+
+
+def invoice(add_index, state=ln.Invoice.OPEN, settle_index=0, created=None, expiry=3600):
+    return ln.Invoice(add_index=add_index, settle_index=settle_index, state=state, r_hash=bytes([add_index]) * 32,
+                      creation_date=int(time.time()) if created is None else created, expiry=expiry)
+
+
+class TestInvoiceStore(TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.store = InvoiceStore(self.client)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_catch_up_rescans_open_invoices_before_any_settlement(self):
+        self.store.save([invoice(1, created=0), invoice(2), invoice(3)])
+        self.store.catch_up()
+        # invoice 1 has expired, 2 could have been settled offline
+        self.assertEqual([1], self.client.start_indexes)
+
+    def test_catch_up_skips_open_invoices_once_settle_index_is_stored(self):
+        self.store.save([invoice(1), invoice(2, state=ln.Invoice.SETTLED, settle_index=1), invoice(3)])
+        self.store.catch_up()
+        self.assertEqual([3], self.client.start_indexes)
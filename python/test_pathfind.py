@@ -0,0 +1,82 @@
+from unittest import TestCase
+
+import rpc_pb2 as ln
+from graph import ChannelGraph
+from pathfind import NoRouteError, Pathfinder
+
+ALICE = '02' + 'aa' * 32
+BOB = '03' + 'bb' * 32
+CAROL = '02' + 'cc' * 32
+DAVE = '03' + 'dd' * 32
+
+
+def policy(fee_base_msat, fee_rate_milli_msat, time_lock_delta=40):
+    return ln.RoutingPolicy(time_lock_delta=time_lock_delta, min_htlc=1, fee_base_msat=fee_base_msat,
+                            fee_rate_milli_msat=fee_rate_milli_msat)
+
+
+# alice -> bob -> carol -> dave, or alice -> carol -> dave which is cheaper
+DESCRIBE_GRAPH = ln.ChannelGraph(edges=[
+    ln.ChannelEdge(channel_id=1, node1_pub=ALICE, node2_pub=BOB, capacity=10000000,
+                   node1_policy=policy(5000, 5000), node2_policy=policy(1000, 100, 10)),
+    ln.ChannelEdge(channel_id=2, node1_pub=BOB, node2_pub=CAROL, capacity=10000000,
+                   node1_policy=policy(2000, 10, 20), node2_policy=policy(1000, 1)),
+    ln.ChannelEdge(channel_id=3, node1_pub=CAROL, node2_pub=DAVE, capacity=10000000,
+                   node1_policy=policy(3000, 20, 30), node2_policy=policy(1000, 1)),
+    ln.ChannelEdge(channel_id=4, node1_pub=ALICE, node2_pub=CAROL, capacity=10000000,
+                   node1_policy=policy(1, 1), node2_policy=policy(100000, 1000, 144))])
+
+
+class TestPathfinder(TestCase):
+
+    def setUp(self):
+        self.graph = ChannelGraph.from_describe_graph(DESCRIBE_GRAPH)
+        self.finder = Pathfinder(self.graph, ALICE)
+
+    def chan_ids(self, path):
+        return [self.graph.chan_id[edge] for edge in path.edges]
+
+    def test_find_paths(self):
+        paths = self.finder.find_paths(DAVE, 1000000, num_routes=3)
+        # only two loopless paths exist
+        self.assertEqual([[4, 3], [1, 2, 3]], [self.chan_ids(path) for path in paths])
+        # alice pays no fee on her own channels
+        self.assertEqual((1003020, 3020, 30), paths[0][1:4])
+        self.assertEqual((1005030, 5030, 50), paths[1][1:4])
+
+        with self.assertRaises(NoRouteError):
+            self.finder.find_paths(DAVE, 20000000000)
+        with self.assertRaises(NoRouteError):
+            self.finder.find_paths('02' + 'ee' * 32, 1000)
+
+    def test_route(self):
+        path = self.finder.find_paths(DAVE, 1000000, num_routes=2)[1]
+        route = self.finder.route(path, height=100, final_cltv_delta=9)
+
+        self.assertEqual((159, 1005030, 5030), (route.total_time_lock, route.total_amt_msat, route.total_fees_msat))
+        self.assertEqual([1, 2, 3], [hop.chan_id for hop in route.hops])
+        self.assertEqual([BOB, CAROL, DAVE], [hop.pub_key for hop in route.hops])
+        self.assertEqual([1003020, 1000000, 1000000], [hop.amt_to_forward_msat for hop in route.hops])
+        self.assertEqual([2010, 3020, 0], [hop.fee_msat for hop in route.hops])
+        self.assertEqual([139, 109, 109], [hop.expiry for hop in route.hops])
+
+    def test_price_many(self):
+        edges = [path.edges for path in self.finder.find_paths(DAVE, 1000000, num_routes=2)]
+        for amt_msat in (1000000, 9999000000):
+            priced = self.finder.price_many(edges, amt_msat)
+            for path, expected in zip(priced, [self.finder.price(path, amt_msat) for path in edges]):
+                self.assertEqual(expected[:4], path[:4])
+                self.assertAlmostEqual(expected.cost, path.cost)
+        # more than the channels hold
+        self.assertEqual([None, None], self.finder.price_many(edges, 20000000000))
+        self.assertEqual([], self.finder.price_many([], 1000))
+
+    def test_columns_follow_graph(self):
+        self.finder.find_paths(DAVE, 1000000)
+        columns = self.finder._columns()
+        self.assertIs(columns, self.finder._columns())
+
+        # closing alice -> carol leaves alice -> bob -> carol -> dave
+        self.graph.close_channel(4)
+        self.assertIsNot(columns, self.finder._columns())
+        self.assertEqual([[1, 2, 3]], [self.chan_ids(path) for path in self.finder.find_paths(DAVE, 1000000, 2)])
@@ -0,0 +1,63 @@
+from concurrent.futures import Future
+from unittest import TestCase
+
+import grpc
+
+import rpc_pb2 as ln
+from payments import PaymentExecutor
+
+DESTINATION = '02' + 'dd' * 32
+
+
+def payment_hash(pay_req):
+    return pay_req.encode().hex().ljust(64, '0')
+
+
+class FakeSendPaymentSync(object):
+    """ SendPaymentSync whose future() raises for payment hashes in `broken` """
+
+    def __init__(self, broken):
+        self.broken = broken
+        self.sent = []
+
+    def future(self, request):
+        if request.payment_hash in self.broken:
+            raise grpc.RpcError('channel closed')
+        self.sent.append(request.payment_hash)
+        future = Future()
+        future.set_result(ln.SendResponse(payment_preimage=b'\x01' * 32))
+        return future
+
+
+class FakeStub(object):
+
+    def __init__(self, broken):
+        self.SendPaymentSync = FakeSendPaymentSync(broken)
+
+
+class FakeClient(object):
+
+    def __init__(self, broken=()):
+        self.client = FakeStub(broken)
+
+    def __str__(self):
+        return 'fake'
+
+    def decode_pay_request(self, pay_req):
+        return ln.PayReq(destination=DESTINATION, payment_hash=payment_hash(pay_req), num_satoshis=1000)
+
+    def send_request(self, details):
+        return details
+
+
+class TestPaymentExecutor(TestCase):
+
+    def test_call_raising_fails_only_its_payment(self):
+        client = FakeClient(broken={payment_hash('b')})
+        results = PaymentExecutor(client, max_in_flight=1, max_per_destination=1).pay(['a', 'b', 'c'])
+
+        self.assertEqual(['a', 'b', 'c'], [result.payment_request for result in results])
+        self.assertEqual([None, None], [results[0].error, results[2].error])
+        self.assertIsInstance(results[1].error, grpc.RpcError)
+        # its slots were given back, so the payment queued behind it was sent
+        self.assertEqual([payment_hash('a'), payment_hash('c')], client.client.SendPaymentSync.sent)
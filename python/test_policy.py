@@ -0,0 +1,145 @@
+import threading
+import time
+from concurrent import futures
+from unittest import TestCase
+
+import grpc
+
+from policy import CallPolicy
+
+
+class Unavailable(grpc.RpcError):
+
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+
+class FailingCall(object):
+    """ Unary multicallable failing with UNAVAILABLE `failures` times, records the timeout of every attempt """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.timeouts = []
+
+    def __call__(self, request, timeout=None):
+        self.timeouts.append(timeout)
+        if len(self.timeouts) <= self.failures:
+            raise Unavailable()
+        return 'ok'
+
+
+class FakeFuture(object):
+    """ grpc future of a unary call, finished by the test """
+
+    def __init__(self):
+        self._future = futures.Future()
+
+    def finish(self, result=None, error=None):
+        # a call the policy cancelled never finishes
+        if self._future.cancelled():
+            return
+        if error is not None:
+            self._future.set_exception(error)
+        else:
+            self._future.set_result(result)
+
+    def result(self, timeout=None):
+        try:
+            return self._future.result(timeout)
+        except futures.TimeoutError:
+            raise grpc.FutureTimeoutError()
+
+    def add_done_callback(self, fn):
+        self._future.add_done_callback(lambda future: fn(self))
+
+    def done(self):
+        return self._future.done()
+
+    def cancelled(self):
+        return self._future.cancelled()
+
+    def exception(self):
+        return self._future.exception()
+
+    def cancel(self):
+        return self._future.cancel()
+
+
+class HedgedCall(object):
+    """ Unary multicallable whose n-th future finishes after outcomes[n] = (delay, result, error) """
+
+    def __init__(self, *outcomes):
+        self.outcomes = outcomes
+        self.calls = []
+
+    def future(self, request, timeout=None):
+        call = FakeFuture()
+        delay, result, error = self.outcomes[len(self.calls)]
+        self.calls.append(call)
+        timer = threading.Timer(delay, call.finish, (result, error))
+        timer.daemon = True
+        timer.start()
+        return call
+
+
+class TestCallPolicy(TestCase):
+
+    def test_retries(self):
+        policy = CallPolicy(timeout=10, attempts=3, initial_backoff=0.01, max_backoff=0.01)
+        call = FailingCall(2)
+        self.assertEqual('ok', policy.call('ListPeers', call, None))
+        self.assertEqual(2, policy.retries)
+        # every attempt gets what is left of the one deadline
+        self.assertEqual(10, call.timeouts[0])
+        self.assertTrue(call.timeouts[0] > call.timeouts[1] > call.timeouts[2] > 9.9)
+
+    def test_deadline_covers_retries(self):
+        policy = CallPolicy(timeout=0.05, attempts=10, initial_backoff=0.02, max_backoff=0.02)
+        call = FailingCall(10)
+        started = time.monotonic()
+        with self.assertRaises(Unavailable):
+            policy.call('ListPeers', call, None)
+        self.assertLess(time.monotonic() - started, 0.05)
+        self.assertLess(len(call.timeouts), 10)
+
+    def test_not_idempotent(self):
+        policy = CallPolicy(timeout=10, attempts=3, initial_backoff=0.01)
+        for method in ('SendPaymentSync', 'DisconnectPeer'):
+            call = FailingCall(1)
+            with self.assertRaises(Unavailable):
+                policy.call(method, call, None)
+            self.assertEqual(1, len(call.timeouts))
+        self.assertEqual(0, policy.retries)
+
+    def hedged(self, *outcomes):
+        policy = CallPolicy(timeout=10, attempts=1, hedge_delay=0.05)
+        call = HedgedCall(*outcomes)
+        return policy, call, lambda: policy.call('GetInfo', call, None)
+
+    def test_hedge_not_needed(self):
+        policy, call, get_info = self.hedged((0, 'first', None))
+        self.assertEqual('first', get_info())
+        self.assertEqual(1, len(call.calls))
+        self.assertEqual(0, policy.hedges)
+
+    def test_slow_first_call_wins(self):
+        policy, call, get_info = self.hedged((0.1, 'first', None), (5, 'second', None))
+        self.assertEqual('first', get_info())
+        self.assertEqual(1, policy.hedges)
+        # the hedge is given up
+        self.assertTrue(call.calls[1].cancelled())
+
+    def test_hedge_wins(self):
+        policy, call, get_info = self.hedged((5, 'first', None), (0.01, 'second', None))
+        self.assertEqual('second', get_info())
+        self.assertTrue(call.calls[0].cancelled())
+        self.assertFalse(call.calls[1].cancelled())
+
+    def test_both_fail(self):
+        # a failed call doesn't win, the first error is raised once the hedge failed too
+        policy, call, get_info = self.hedged((0.06, None, Unavailable()), (0.05, None, Unavailable()))
+        started = time.monotonic()
+        with self.assertRaises(Unavailable):
+            get_info()
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertFalse(any(future.cancelled() for future in call.calls))
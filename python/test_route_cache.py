@@ -0,0 +1,94 @@
+from unittest import TestCase
+
+import rpc_pb2 as ln
+from route_cache import RouteCache
+
+ALICE = '02' + 'aa' * 32
+BOB = '03' + 'bb' * 32
+CAROL = '02' + 'cc' * 32
+DAVE = '03' + 'dd' * 32
+
+
+def route(*hops):
+    return ln.Route(hops=[ln.Hop(chan_id=chan_id, chan_capacity=1000000, pub_key=pub_key) for chan_id, pub_key in hops])
+
+
+class FakeFuture(object):
+
+    def __init__(self, edge):
+        self.edge = edge
+
+    def result(self):
+        return self.edge
+
+
+class FakeGetChanInfo(object):
+    """ GetChanInfo.future answering from `edges` """
+
+    def __init__(self, edges):
+        self.edges = edges
+
+    def future(self, request):
+        return FakeFuture(self.edges[request.chan_id])
+
+
+class FakeStub(object):
+
+    def __init__(self, routes, edges):
+        self.routes = routes
+        self.GetChanInfo = FakeGetChanInfo(edges)
+
+    def QueryRoutes(self, request):
+        return ln.QueryRoutesResponse(routes=self.routes[request.pub_key])
+
+    def GetInfo(self, request):
+        return ln.GetInfoResponse(block_height=100)
+
+
+class FakeClient(object):
+
+    def __init__(self, routes, edges):
+        self.client = FakeStub(routes, edges)
+
+    def __str__(self):
+        return 'fake'
+
+
+class TestRouteCache(TestCase):
+
+    def setUp(self):
+        policy = ln.RoutingPolicy(time_lock_delta=40, fee_base_msat=1000, fee_rate_milli_msat=100)
+        edges = {2: ln.ChannelEdge(channel_id=2, node1_pub=BOB, node2_pub=DAVE, node1_policy=policy),
+                 # carol never announced a policy for channel 4
+                 4: ln.ChannelEdge(channel_id=4, node1_pub=CAROL, node2_pub=DAVE)}
+        routes = {DAVE: [route((1, BOB), (2, DAVE)), route((3, CAROL), (4, DAVE))],
+                  CAROL: [route((3, CAROL))]}
+        self.cache = RouteCache(FakeClient(routes, edges), maxsize=2)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_missing_policy(self):
+        entry = self.cache.fetch(DAVE, 1000)
+        # the route over channel 4 could not be repriced
+        self.assertEqual([[1, 2]], [[channel.chan_id for channel in channels] for channels in entry])
+        self.assertEqual((0, 0, 0), entry[0][0][3:])
+        self.assertEqual((1000, 100, 40), entry[0][1][3:])
+
+        route, = self.cache.routes(DAVE, 1000)
+        self.assertEqual(1001100, route.total_amt_msat)
+        # height, the default final cltv delta and bob's time lock delta
+        self.assertEqual(100 + 40 + 40, route.total_time_lock)
+
+    def test_keys_pruned(self):
+        self.cache.fetch(DAVE, 1000)
+        self.cache.fetch(CAROL, 1000)
+        self.cache.fetch(CAROL, 3000)
+        self.cache.fetch(CAROL, 5000)
+        # the LRU dropped the entries to dave, the index of the channels they used went with them
+        self.assertEqual(2, len(self.cache.entries))
+        self.assertEqual({3: {(CAROL, 4096), (CAROL, 8192)}}, dict(self.cache._keys))
+
+        self.cache.invalidate_channels([3])
+        self.assertEqual(0, len(self.cache.entries))
+        self.assertEqual(2, self.cache.invalidations)
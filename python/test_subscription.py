@@ -0,0 +1,51 @@
+from unittest import TestCase
+
+import rpc_pb2 as ln
+from subscription import InvoiceSubscriber
+
+
+class FakeStub(object):
+
+    def __init__(self, invoices):
+        self.invoices = invoices
+        self.subscriptions = []
+
+    def ListInvoices(self, request):
+        assert request.reversed
+        return ln.ListInvoiceResponse(invoices=self.invoices[-request.num_max_invoices:])
+
+    def SubscribeInvoices(self, request, wait_for_ready=None):
+        self.subscriptions.append(request)
+        self.subscriber.stop()
+        return iter([])
+
+
+class FakeClient(object):
+
+    def __init__(self, invoices):
+        self.client = FakeStub(invoices)
+
+
+def subscribe(invoices, **kwargs):
+    client = FakeClient(invoices)
+    subscriber = client.client.subscriber = InvoiceSubscriber(client, **kwargs)
+    subscriber._read()
+    return client.client.subscriptions[0]
+
+
+class TestInvoiceSubscriber(TestCase):
+
+    def test_zero_indexes_are_seeded_from_the_newest_invoices(self):
+        invoices = [ln.Invoice(add_index=1, settle_index=2), ln.Invoice(add_index=2, settle_index=1),
+                    ln.Invoice(add_index=3)]
+        request = subscribe(invoices)
+        self.assertEqual((3, 2), (request.add_index, request.settle_index))
+
+    def test_given_indexes_are_kept(self):
+        request = subscribe([ln.Invoice(add_index=3, settle_index=2)], add_index=1, settle_index=1)
+        self.assertEqual((1, 1), (request.add_index, request.settle_index))
+
+    def test_seeding_reads_only_seed_invoices(self):
+        invoices = [ln.Invoice(add_index=1, settle_index=1), ln.Invoice(add_index=2)]
+        request = subscribe(invoices, seed_invoices=1)
+        self.assertEqual((2, 0), (request.add_index, request.settle_index))
@@ -0,0 +1,123 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from unittest import TestCase
+
+from utils import EVENT_LOGGERS, LOGGERS, SampleFilter, configure_logging, lazy_import
+
+# Module that fails to import while LAZY_FAIL is set and counts how often it was executed
+LAZY_MODULE = '''
+import os
+import time
+time.sleep(0.05)
+executions = int(os.environ.get('LAZY_EXECUTIONS', 0)) + 1
+os.environ['LAZY_EXECUTIONS'] = str(executions)
+if os.environ.get('LAZY_FAIL'):
+    raise ImportError('not today')
+value = 42
+'''
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestLazyImport(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        # lazy_import keeps its stand-ins, so every test gets its own module
+        self.name = f'lazy_{self._testMethodName}'
+        with open(os.path.join(self.path, f'{self.name}.py'), 'w') as module:
+            module.write(LAZY_MODULE)
+        sys.path.insert(0, self.path)
+        os.environ['LAZY_EXECUTIONS'] = '0'
+
+    def tearDown(self):
+        sys.path.remove(self.path)
+        sys.modules.pop(self.name, None)
+        os.environ.pop('LAZY_FAIL', None)
+        shutil.rmtree(self.path)
+
+    def test_lazy_import(self):
+        module = lazy_import(self.name)
+        self.assertNotIn(self.name, sys.modules)
+        self.assertEqual('0', os.environ['LAZY_EXECUTIONS'])
+
+        values = []
+        threads = [threading.Thread(target=lambda: values.append(module.value)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([42] * 8, values)
+        self.assertEqual('1', os.environ['LAZY_EXECUTIONS'])
+        self.assertIs(sys.modules[self.name], lazy_import(self.name))
+
+        with self.assertRaises(ImportError):
+            lazy_import('lazy_missing')
+
+    def test_failed_import(self):
+        os.environ['LAZY_FAIL'] = '1'
+        module = lazy_import(self.name)
+        for _ in range(2):
+            with self.assertRaisesRegex(ImportError, 'not today'):
+                module.value
+        self.assertNotIn(self.name, sys.modules)
+
+        del os.environ['LAZY_FAIL']
+        self.assertEqual(42, module.value)
+        self.assertEqual('3', os.environ['LAZY_EXECUTIONS'])
+
+
+class TestLogging(TestCase):
+
+    def setUp(self):
+        names = LOGGERS + EVENT_LOGGERS + ('',)
+        self.saved = {name: (logging.getLogger(name).level, logging.getLogger(name).propagate,
+                             list(logging.getLogger(name).handlers), list(logging.getLogger(name).filters))
+                      for name in names}
+
+    def tearDown(self):
+        for name, (level, propagate, handlers, filters) in self.saved.items():
+            restored = logging.getLogger(name)
+            restored.setLevel(level)
+            restored.propagate = propagate
+            restored.handlers = handlers
+            restored.filters = filters
+
+    def test_sample_filter(self):
+        sample = SampleFilter(3)
+        record = logging.LogRecord('payments.events', logging.INFO, __file__, 0, 'paid', None, None)
+        self.assertEqual([True, False, False] * 3, [sample.filter(record) for _ in range(9)])
+
+    def test_configure_logging(self):
+        handler = ListHandler()
+        root_handlers = list(logging.getLogger().handlers)
+        configure_logging(logging.DEBUG, sample_every=2, handler=handler)
+        # twice, handlers and filters are replaced rather than added
+        configure_logging(logging.DEBUG, sample_every=2, handler=handler)
+
+        for name in LOGGERS:
+            package_logger = logging.getLogger(name)
+            self.assertEqual([handler], package_logger.handlers)
+            self.assertEqual(logging.DEBUG, package_logger.level)
+            self.assertFalse(package_logger.propagate)
+        self.assertEqual(root_handlers, logging.getLogger().handlers)
+
+        logging.getLogger('lnd').debug('connected')
+        for i in range(4):
+            logging.getLogger('payments.events').info(f'paid {i}')
+        self.assertEqual(['connected', 'paid 0', 'paid 2'], [record.getMessage() for record in handler.records])
+
+        configure_logging(handler=handler)
+        self.assertEqual([], [f for f in logging.getLogger('payments.events').filters if isinstance(f, SampleFilter)])
@@ -1,10 +1,119 @@
+import configparser
+import importlib.util
+import itertools
 import logging
+import os
+import random
 import subprocess
+import sys
+import threading
+import types
 
-logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(message)s', )
 logger = logging.getLogger(__name__)
 
 
+class _LazyModule(types.ModuleType):
+    """ Stands in for a module until the first attribute access imports it
+
+    The import goes through importlib.import_module, so concurrent first accesses wait on the import lock and a
+    failed import leaves nothing half initialised behind: the next access tries again and raises the real error.
+    """
+
+    def __getattr__(self, attr):
+        # only reached for attributes missing from the copy of the module's namespace
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(importlib.import_module(self.__name__), attr, value)
+        super(_LazyModule, self).__setattr__(attr, value)
+
+
+_lazy_modules = {}
+_lazy_lock = threading.Lock()
+
+
+def lazy_import(name):
+    """ Module that is only imported on first attribute access
+
+    grpc and the generated rpc_pb2 descriptors take most of the import time of this package, short lived
+    jobs shouldn't pay for them before (or without) their first RPC.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    with _lazy_lock:
+        if name not in _lazy_modules:
+            if importlib.util.find_spec(name) is None:
+                raise ImportError(f'No module named {name!r}', name=name)
+            _lazy_modules[name] = _LazyModule(name)
+        return _lazy_modules[name]
+
+
+def check_limit(name, value):
+    """ value if it is an int >= 1, ValueError otherwise (a zero sized semaphore would block forever) """
+    if not isinstance(value, int) or value < 1:
+        raise ValueError(f'{name} must be at least 1, got {value!r}')
+    return value
+
+
+def protobuf_backend():
+    """ Protobuf implementation in use: 'cpp' (C++ extension), 'upb' or 'python'
+
+    The C++ extension is picked automatically when the installed protobuf wheel ships it, set
+    PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=cpp (before the first RPC) to require it.
+    """
+    from google.protobuf.internal import api_implementation
+    return api_implementation.Type()
+
+
+# Loggers of this package, configure_logging() sets them up instead of the root logger
+LOGGERS = ('lnd', 'bolt11', 'cache', 'channel_pool', 'channels', 'graph', 'invoice_store', 'metrics', 'pathfind',
+           'payments', 'policy', 'route_cache', 'subscription', 'utils')
+
+# Per-event loggers of high rate streams, subject to sampling
+EVENT_LOGGERS = ('payments.events', 'subscription.events')
+
+
+class SampleFilter(logging.Filter):
+    """ Passes one record in `every` """
+
+    def __init__(self, every):
+        super(SampleFilter, self).__init__()
+        self.every = every
+        self._count = itertools.count()
+
+    def filter(self, record):
+        return next(self._count) % self.every == 0
+
+
+def configure_logging(level=logging.INFO, format='%(levelname)s %(name)s: %(message)s', sample_every=None,
+                      handler=None):
+    """ Send this package's logs at `level` to stderr (or `handler`), leaving the root logger alone
+
+    :param sample_every: log only one in `sample_every` per-event stream records (EVENT_LOGGERS)
+    """
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(format))
+    handler.configured_by_utils = True
+
+    for name in LOGGERS:
+        package_logger = logging.getLogger(name)
+        package_logger.setLevel(level)
+        for old in [h for h in package_logger.handlers if getattr(h, 'configured_by_utils', False)]:
+            package_logger.removeHandler(old)
+        package_logger.addHandler(handler)
+        package_logger.propagate = False
+
+    for name in EVENT_LOGGERS:
+        event_logger = logging.getLogger(name)
+        for old in [f for f in event_logger.filters if isinstance(f, SampleFilter)]:
+            event_logger.removeFilter(old)
+        if sample_every and sample_every > 1:
+            event_logger.addFilter(SampleFilter(sample_every))
+
+
 def get_docker_ip(node):
     args = ['docker', 'inspect', '-f', "{{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}", node]
     try:
@@ -32,3 +141,30 @@ def restart_docker(node):
         raise RuntimeError(
             "Command '{}' return with error (code {}): {}".format(
                 exc.cmd, exc.returncode, exc.output))
+
+
+def backoff(initial=0.5, maximum=30.0, factor=2.0):
+    """ Endless generator of exponentially growing delays with full jitter """
+    delay = initial
+    while True:
+        yield random.uniform(0, delay)
+        delay = min(delay * factor, maximum)
+
+
+LND_CONF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lnd', 'lnd.conf')
+
+
+def lnd_conf_option(name, path=LND_CONF, default=None):
+    """ Value of an option from an lnd.conf file (any section), or default """
+    parser = configparser.ConfigParser(strict=False, interpolation=None, inline_comment_prefixes=(';',))
+    try:
+        with open(path, encoding='utf-8') as conf:
+            parser.read_file(conf)
+    except (OSError, configparser.Error) as e:
+        logger.debug(f'Can\'t read {path}: {e}')
+        return default
+
+    for section in parser.sections():
+        if parser.has_option(section, name):
+            return parser.get(section, name)
+    return default